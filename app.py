@@ -1,17 +1,21 @@
+import os
 import sys
 import hashlib
 from collections import OrderedDict
 
 try:
-    from flask import Flask, render_template, Response
-    from flask_socketio import SocketIO
+    from flask import Flask, render_template, Response, request, jsonify
+    from flask_socketio import SocketIO, emit
     from clases import (Nodo, Hospital, Ruta, Ambulancia, Via, 
-                       ListaEnlazada, ArbolBinarioBusqueda, Grafo)
+                       ListaEnlazada, ArbolBinarioBusqueda, Grafo,
+                       AlmacenGeometrias, EstadoVersionado, PlanRuta, CacheSubrutas)
+    from trazas import Trazador
     import requests
     import threading
     import time
     import random
     import math
+    import itertools
     from concurrent.futures import ThreadPoolExecutor, as_completed
 except ImportError as e:
     print(f"Error: Faltan dependencias. Ejecuta: pip install flask flask-socketio requests")
@@ -19,7 +23,19 @@ except ImportError as e:
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# threading por defecto; eventlet/gevent requieren su monkey patching antes de importar este módulo
+ASYNC_MODE = os.environ.get('SIMULADOR_ASYNC_MODE', 'threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+
+# ----- TRAZAS -----
+# Se activan en caliente desde /trazas/* o al arrancar con SIMULADOR_TRAZAS=1
+TRAZADOR = Trazador()
+if os.environ.get("SIMULADOR_TRAZAS") == "1":
+    TRAZADOR.activar()
+
+def emitir(evento, datos):
+    with TRAZADOR.span("socketio.emit", evento=evento):
+        socketio.emit(evento, datos)
 
 # ----- CONFIGURACIÓN INICIAL -----
 hospitales = [
@@ -47,11 +63,26 @@ ambulancias = [
     Ambulancia("AMB-003", *generar_ubicacion_aleatoria(), especialidad="General")
 ]
 
+# Registro único de la flota por id: los hilos de simulación, el despacho y las
+# reservas actúan siempre sobre los mismos objetos
+FLOTA = {a.id: a for a in ambulancias}
+
+def registrar_ambulancia(amb):
+    """Agrega una unidad a la flota (antes de iniciar la simulación)"""
+    ambulancias.append(amb)
+    FLOTA[amb.id] = amb
+
 # ----- CACHÉ DE RUTAS -----
 CACHE_RUTAS = OrderedDict()
 MAX_CACHE_SIZE = 500
 CACHE_TTL = 300
 
+# Cada geometría se guarda una sola vez; caché, rutas e historial comparten la vista
+GEOMETRIAS = AlmacenGeometrias(max_geometrias=MAX_CACHE_SIZE * 2)
+
+# Rutas de los proveedores indexadas por teselas geohash para reutilizar sub-trayectos
+SUBRUTAS = CacheSubrutas(precision=7, tolerancia_km=0.1, max_rutas=MAX_CACHE_SIZE, ttl=CACHE_TTL)
+
 def _generar_clave_cache(origen, destino):
     coords = f"{origen.lat:.6f},{origen.lon:.6f};{destino.lat:.6f},{destino.lon:.6f}"
     return hashlib.md5(coords.encode()).hexdigest()
@@ -72,7 +103,19 @@ def _guardar_en_cache(origen, destino, resultado):
         CACHE_RUTAS.popitem(last=False)
     CACHE_RUTAS[clave] = (resultado, time.time())
 
+def _registrar_ruta_proveedor(origen, destino, resultado):
+    # Una ruta nueva de un proveedor alimenta la caché exacta, las sub-rutas y la red vial
+    _guardar_en_cache(origen, destino, resultado)
+    SUBRUTAS.guardar(*resultado)
+    incorporar_a_red_vial(resultado[0])
+
 # ----- FUNCIONES AUXILIARES -----
+# URLs base configurables para apuntar a un servidor local de pruebas (ver carga.py)
+GRAPHHOPPER_URL = os.environ.get('SIMULADOR_GRAPHHOPPER_URL', 'https://graphhopper.com')
+ORS_URL = os.environ.get('SIMULADOR_ORS_URL', 'https://api.openrouteservice.org')
+OSRM_URL = os.environ.get('SIMULADOR_OSRM_URL', 'https://router.project-osrm.org')
+ORS_API_KEY = "5b3ce3597851110001cf6248a1b7c8d4c8b84f8b9b8f8f8f8f8f8f8f8f8f8"
+
 def calcular_distancia_km(nodo1, nodo2):
     R = 6371
     lat1, lon1 = math.radians(nodo1.lat), math.radians(nodo1.lon)
@@ -82,10 +125,11 @@ def calcular_distancia_km(nodo1, nodo2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     return R * c
 
+@TRAZADOR.trazar()
 def obtener_ruta_graphhopper(origen, destino, max_retries=2):
     for intento in range(max_retries):
         try:
-            url = "https://graphhopper.com/api/1/route"
+            url = f"{GRAPHHOPPER_URL}/api/1/route"
             params = [
                 ('point', f"{origen.lat},{origen.lon}"),
                 ('point', f"{destino.lat},{destino.lon}"),
@@ -132,14 +176,14 @@ def obtener_ruta_graphhopper(origen, destino, max_retries=2):
             pass
     return None, None, None
 
+@TRAZADOR.trazar()
 def obtener_ruta_openrouteservice(origen, destino, max_retries=2):
     for intento in range(max_retries):
         try:
-            api_key = "5b3ce3597851110001cf6248a1b7c8d4c8b84f8b9b8f8f8f8f8f8f8f8f8f8"
-            url = "https://api.openrouteservice.org/v2/directions/driving-car"
+            url = f"{ORS_URL}/v2/directions/driving-car"
             headers = {
                 'Accept': 'application/json, application/geo+json',
-                'Authorization': api_key,
+                'Authorization': ORS_API_KEY,
                 'Content-Type': 'application/json'
             }
             body = {
@@ -182,10 +226,11 @@ def obtener_ruta_openrouteservice(origen, destino, max_retries=2):
             pass
     return None, None, None
 
+@TRAZADOR.trazar()
 def obtener_ruta_osrm(origen, destino, max_retries=1):
     for intento in range(max_retries):
         try:
-            url = f"https://router.project-osrm.org/route/v1/driving/{origen.lon},{origen.lat};{destino.lon},{destino.lat}"
+            url = f"{OSRM_URL}/route/v1/driving/{origen.lon},{origen.lat};{destino.lon},{destino.lat}"
             params = {
                 'overview': 'full',
                 'geometries': 'geojson',
@@ -231,14 +276,125 @@ def obtener_ruta_osrm(origen, destino, max_retries=1):
             return None, None, None
     return None, None, None
 
+# ----- MATRICES DE DURACIÓN -----
+MATRIZ_ACTIVA = True
+MATRIZ_MAX_COORDENADAS = 100      # coordenadas por petición (límite del OSRM público)
+MATRIZ_MAX_ELEMENTOS = 3500       # pares origen-destino por petición (límite de OpenRouteService)
+MATRIZ_CANDIDATOS_GEOMETRIA = 3   # candidatos a probar si falla la geometría del mejor
+
+@TRAZADOR.trazar()
+def obtener_matriz_openrouteservice(origenes, destinos, max_retries=2):
+    for intento in range(max_retries):
+        try:
+            url = f"{ORS_URL}/v2/matrix/driving-car"
+            headers = {
+                'Accept': 'application/json',
+                'Authorization': ORS_API_KEY,
+                'Content-Type': 'application/json'
+            }
+            body = {
+                "locations": [[n.lon, n.lat] for n in list(origenes) + list(destinos)],
+                "sources": list(range(len(origenes))),
+                "destinations": list(range(len(origenes), len(origenes) + len(destinos))),
+                "metrics": ["duration"]
+            }
+            timeout = 15 + (intento * 5)
+            response = requests.post(url, json=body, headers=headers, timeout=timeout)
+            
+            if response.status_code != 200:
+                if intento < max_retries - 1:
+                    time.sleep(0.5 * (2 ** intento))
+                    continue
+                return None
+            
+            duraciones = response.json().get("durations")
+            if not duraciones:
+                return None
+            return [[d / 60 if d is not None else None for d in fila] for fila in duraciones]
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if intento < max_retries - 1:
+                time.sleep(0.5 * (2 ** intento))
+                continue
+        except Exception:
+            pass
+    return None
+
+@TRAZADOR.trazar()
+def obtener_matriz_osrm(origenes, destinos, max_retries=1):
+    for intento in range(max_retries):
+        try:
+            coordenadas = ";".join(f"{n.lon},{n.lat}" for n in list(origenes) + list(destinos))
+            url = f"{OSRM_URL}/table/v1/driving/{coordenadas}"
+            params = {
+                'sources': ";".join(str(i) for i in range(len(origenes))),
+                'destinations': ";".join(str(len(origenes) + j) for j in range(len(destinos))),
+                'annotations': 'duration'
+            }
+            timeout = 8 + (intento * 3)
+            response = requests.get(url, params=params, timeout=timeout, headers={'User-Agent': 'Mozilla/5.0'})
+            
+            if response.status_code != 200:
+                return None
+            
+            r = response.json()
+            if r.get("code") != "Ok" or not r.get("durations"):
+                return None
+            return [[d / 60 if d is not None else None for d in fila] for fila in r["durations"]]
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            return None
+        except Exception:
+            return None
+    return None
+
+def _bloques_matriz(num_origenes, num_destinos):
+    """Divide la matriz en bloques que respetan los límites de coordenadas y pares por petición"""
+    tam_destinos = max(1, min(num_destinos, MATRIZ_MAX_COORDENADAS // 2))
+    tam_origenes = max(1, min(MATRIZ_MAX_COORDENADAS - tam_destinos, MATRIZ_MAX_ELEMENTOS // tam_destinos))
+    for i0 in range(0, num_origenes, tam_origenes):
+        for j0 in range(0, num_destinos, tam_destinos):
+            yield i0, min(i0 + tam_origenes, num_origenes), j0, min(j0 + tam_destinos, num_destinos)
+
+@TRAZADOR.trazar()
+def obtener_matriz_duraciones(origenes, destinos):
+    """
+    Matriz de duraciones en minutos [origen][destino] con una petición por bloque
+    Los pares sin dato (bloque fallido o sin ruta) quedan en None
+    """
+    matriz = [[None] * len(destinos) for _ in origenes]
+    servicios = [
+        obtener_matriz_openrouteservice,
+        obtener_matriz_osrm
+    ]
+    for i0, i1, j0, j1 in _bloques_matriz(len(origenes), len(destinos)):
+        for servicio in servicios:
+            try:
+                parcial = servicio(origenes[i0:i1], destinos[j0:j1])
+            except Exception:
+                continue
+            if parcial and len(parcial) == i1 - i0 and all(len(fila) == j1 - j0 for fila in parcial):
+                for i, fila in enumerate(parcial):
+                    matriz[i0 + i][j0:j1] = fila
+                break
+    return matriz
+
+@TRAZADOR.trazar()
 def obtener_ruta_real(origen, destino):
     resultado_cache = _obtener_de_cache(origen, destino)
     if resultado_cache:
         nodos_ruta, distancia, tiempo = resultado_cache
         # Verificar que el caché tenga una ruta válida con más de 2 nodos
         if nodos_ruta and len(nodos_ruta) > 2:
+            TRAZADOR.instante("cache_hit")
             return resultado_cache
     
+    # Un tramo de una ruta ya conocida que pase cerca del origen y luego del destino
+    resultado_subruta = SUBRUTAS.buscar(origen, destino)
+    if resultado_subruta and len(resultado_subruta[0]) > 2:
+        TRAZADOR.instante("subruta_hit")
+        _guardar_en_cache(origen, destino, resultado_subruta)
+        return resultado_subruta
+    TRAZADOR.instante("cache_miss")
+    
     servicios = [
         obtener_ruta_openrouteservice,
         obtener_ruta_graphhopper,
@@ -252,24 +408,32 @@ def obtener_ruta_real(origen, destino):
             nodos_ruta, distancia, tiempo = servicio(origen, destino)
             # Solo aceptar rutas con más de 2 nodos (rutas reales que siguen carreteras)
             if nodos_ruta and len(nodos_ruta) > 2 and tiempo is not None and tiempo > 0:
-                resultado = (nodos_ruta, distancia, tiempo)
-                _guardar_en_cache(origen, destino, resultado)
+                resultado = (GEOMETRIAS.guardar(nodos_ruta), distancia, tiempo)
+                _registrar_ruta_proveedor(origen, destino, resultado)
                 return resultado
         except Exception:
             continue
     
     return None, None, None
 
+def penalizacion_hospital(amb, h):
+    # Parte del costo que depende solo del estado del hospital y la especialidad
+    match_especialidad = 1.0 if amb.especialidad in h.especialidades else 0.5
+    penalizacion_ocupacion = h.porcentaje_ocupacion() * 5
+    penalizacion_espera = h.tiempo_espera
+    return penalizacion_espera + penalizacion_ocupacion + (1 - match_especialidad) * 3
+
+def calcular_costo(amb, h, tiempo_base):
+    trafico = random.uniform(0, 0.5)
+    tiempo_con_trafico = tiempo_base * (1 + trafico * 2)
+    return tiempo_con_trafico + penalizacion_hospital(amb, h)
+
 def calcular_costo_ruta(amb, h, nodos_ruta, tiempo_base):
     if nodos_ruta and len(nodos_ruta) >= 2 and tiempo_base is not None and tiempo_base > 0:
-        match_especialidad = 1.0 if amb.especialidad in h.especialidades else 0.5
-        penalizacion_ocupacion = h.porcentaje_ocupacion() * 5
-        penalizacion_espera = h.tiempo_espera
-        trafico = random.uniform(0, 0.5)
-        tiempo_con_trafico = tiempo_base * (1 + trafico * 2)
-        return tiempo_con_trafico + penalizacion_espera + penalizacion_ocupacion + (1 - match_especialidad) * 3
+        return calcular_costo(amb, h, tiempo_base)
     return None
 
+@TRAZADOR.trazar()
 def evaluar_hospital(amb, h):
     # Intentar obtener ruta real con múltiples intentos
     # NUNCA usar línea recta - solo rutas reales que sigan las carreteras
@@ -301,10 +465,11 @@ def evaluar_hospital(amb, h):
             try:
                 nodos_ruta, distancia_real, tiempo_base = servicio(amb.pos, Nodo(h.lat, h.lon))
                 if nodos_ruta and len(nodos_ruta) > 2 and tiempo_base is not None and tiempo_base > 0:
+                    nodos_ruta = GEOMETRIAS.guardar(nodos_ruta)
                     costo = calcular_costo_ruta(amb, h, nodos_ruta, tiempo_base)
                     if costo is not None and costo > 0:
                         # Guardar en caché para futuras consultas
-                        _guardar_en_cache(amb.pos, Nodo(h.lat, h.lon), (nodos_ruta, distancia_real, tiempo_base))
+                        _registrar_ruta_proveedor(amb.pos, Nodo(h.lat, h.lon), (nodos_ruta, distancia_real, tiempo_base))
                         return (h, nodos_ruta, costo)
             except Exception:
                 if intento_servicio < 1:
@@ -338,12 +503,50 @@ def hospital_to_dict(h):
         "porcentaje_ocupacion": round(h.porcentaje_ocupacion() * 100, 1)
     }
 
+def hospitales_json(instantanea):
+    return [hospital_to_dict(h) for h in instantanea.hospitales]
+
+def ambulancias_json(instantanea):
+    return list(instantanea.ambulancias)
+
+# ----- ESTADO VERSIONADO -----
+# Los hilos de simulación publican hospitales nuevos y el transmisor la flota, una vez por tick
+ESTADO = EstadoVersionado(hospitales, [ambulancia_to_dict(a) for a in ambulancias])
+
 # ----- ASIGNACIÓN CON RUTAS REALES -----
+def _mejor_desde_matriz(amb, hospitales_disponibles, duraciones, indice_destinos):
+    """
+    Ordena los candidatos por la fila de la matriz y descarga la geometría
+    solo del mejor (o del siguiente si esa ruta falla)
+    Retorna un árbol con el candidato resuelto, vacío si no se pudo
+    """
+    candidatos = ArbolBinarioBusqueda()
+    for h in hospitales_disponibles:
+        tiempo_base = duraciones[indice_destinos[h.nombre]]
+        if tiempo_base is not None and tiempo_base > 0:
+            candidatos.insertar(h, calcular_costo(amb, h, tiempo_base))
+    
+    resuelto = ArbolBinarioBusqueda()
+    for h, costo in candidatos.obtener_menores(MATRIZ_CANDIDATOS_GEOMETRIA):
+        nodos_ruta, _, _ = obtener_ruta_real(amb.pos, Nodo(h.lat, h.lon))
+        if nodos_ruta and len(nodos_ruta) > 2:
+            resuelto.insertar((h, nodos_ruta), costo)
+            break
+    return resuelto
+
+@TRAZADOR.trazar()
 def asignar_hospitales_dijkstra(ambulancias, hospitales):
     asignaciones = {}
     hospitales_usados = set()
     
-    for amb in ambulancias:
+    # Matriz ambulancias x hospitales en una o pocas peticiones en lugar de una ruta por par
+    matriz = None
+    destinos = [h for h in hospitales if h.puede_recibir()]
+    if MATRIZ_ACTIVA and ambulancias and destinos:
+        matriz = obtener_matriz_duraciones([a.pos for a in ambulancias], [Nodo(h.lat, h.lon) for h in destinos])
+        indice_destinos = {h.nombre: j for j, h in enumerate(destinos)}
+    
+    for fila, amb in enumerate(ambulancias):
         hospitales_disponibles = [h for h in hospitales if h.puede_recibir() and h.nombre not in hospitales_usados]
         if not hospitales_disponibles:
             hospitales_disponibles = [h for h in hospitales if h.puede_recibir()]
@@ -354,21 +557,26 @@ def asignar_hospitales_dijkstra(ambulancias, hospitales):
         # Usar Árbol Binario de Búsqueda para organizar hospitales por costo
         arbol_hospitales = ArbolBinarioBusqueda()
         
-        with ThreadPoolExecutor(max_workers=min(len(hospitales_disponibles), 6)) as executor:
-            futures = {executor.submit(evaluar_hospital, amb, h): h for h in hospitales_disponibles}
-            
-            for future in as_completed(futures):
-                try:
-                    resultado = future.result()
-                    if resultado is None:
+        if matriz and any(d is not None for d in matriz[fila]):
+            arbol_hospitales = _mejor_desde_matriz(amb, hospitales_disponibles, matriz[fila], indice_destinos)
+        
+        # Sin matriz (o sin geometría para sus candidatos) se evalúa cada par por separado
+        if arbol_hospitales.esta_vacio():
+            with ThreadPoolExecutor(max_workers=min(len(hospitales_disponibles), 6)) as executor:
+                futures = {executor.submit(evaluar_hospital, amb, h): h for h in hospitales_disponibles}
+                
+                for future in as_completed(futures):
+                    try:
+                        resultado = future.result()
+                        if resultado is None:
+                            continue
+                        h, nodos_ruta, costo = resultado
+                        # Solo aceptar rutas con más de 2 nodos (rutas reales que siguen carreteras)
+                        if nodos_ruta and len(nodos_ruta) > 2 and costo is not None:
+                            # Insertar en el árbol binario ordenado por costo
+                            arbol_hospitales.insertar((h, nodos_ruta), costo)
+                    except:
                         continue
-                    h, nodos_ruta, costo = resultado
-                    # Solo aceptar rutas con más de 2 nodos (rutas reales que siguen carreteras)
-                    if nodos_ruta and len(nodos_ruta) > 2 and costo is not None:
-                        # Insertar en el árbol binario ordenado por costo
-                        arbol_hospitales.insertar((h, nodos_ruta), costo)
-                except:
-                    continue
         
                 # Obtener el hospital con menor costo del árbol
         if not arbol_hospitales.esta_vacio():
@@ -387,16 +595,17 @@ def asignar_hospitales_dijkstra(ambulancias, hospitales):
                 
                 # Construir el grafo y aplicar Dijkstra
                 grafo = Grafo()
-                distancia_grafo, camino_grafo, tiempo_grafo = grafo.construir_grafo_desde_ruta(
-                    mejor_ruta_nodos,
-                    distancia_total_ruta if distancia_total_ruta > 0 else calcular_distancia_km(amb.pos, Nodo(mejor_h.lat, mejor_h.lon)),
-                    amb.id,
-                    mejor_h.nombre,
-                    amb.pos.lat,
-                    amb.pos.lon,
-                    mejor_h.lat,
-                    mejor_h.lon
-                )
+                with TRAZADOR.span("construir_grafo_desde_ruta", nodos=len(mejor_ruta_nodos)):
+                    distancia_grafo, camino_grafo, tiempo_grafo = grafo.construir_grafo_desde_ruta(
+                        mejor_ruta_nodos,
+                        distancia_total_ruta if distancia_total_ruta > 0 else calcular_distancia_km(amb.pos, Nodo(mejor_h.lat, mejor_h.lon)),
+                        amb.id,
+                        mejor_h.nombre,
+                        amb.pos.lat,
+                        amb.pos.lon,
+                        mejor_h.lat,
+                        mejor_h.lon
+                    )
                 
                 # Usar la ruta del grafo (resultado de Dijkstra) si está disponible y es válida
                 # Si el grafo no devuelve una ruta válida, usar la ruta original de la API
@@ -409,6 +618,7 @@ def asignar_hospitales_dijkstra(ambulancias, hospitales):
                     print(f"[GRAFO] {amb.id} -> {mejor_h.nombre}: Usando ruta original con {len(mejor_ruta_nodos)} nodos (grafo falló)")
                 
                 if ruta_final and len(ruta_final) > 2:
+                    ruta_final = GEOMETRIAS.guardar(ruta_final)
                     ruta = Ruta(ruta_final, round(mejor_costo, 1))
                     asignaciones[amb.id] = (mejor_h, ruta, round(mejor_costo, 1))
                     hospitales_usados.add(mejor_h.nombre)
@@ -424,6 +634,476 @@ def asignar_hospitales_dijkstra(ambulancias, hospitales):
     
     return asignaciones
 
+# ----- PREFETCH ESPECULATIVO DE RUTAS -----
+PREFETCH_ACTIVO = True
+PREFETCH_PRESUPUESTO = 6     # peticiones HTTP a proveedores en segundo plano por ronda
+PREFETCH_INTERVALO = 1.0     # segundos entre rondas
+PREFETCH_HOSPITALES = 3      # hospitales candidatos por posición prevista
+PREFETCH_POSICIONES = 3      # posiciones previstas por ruta
+PREFETCH_MAX_PENDIENTES = 100
+
+class PrefetcherRutas:
+    """
+    Calienta CACHE_RUTAS en segundo plano con las rutas que pedirá la próxima
+    asignación, desde las posiciones por las que pasará cada ambulancia
+    """
+    def __init__(self, presupuesto, intervalo, max_pendientes):
+        self.presupuesto = presupuesto
+        self.intervalo = intervalo
+        self.max_pendientes = max_pendientes
+        self._pendientes = OrderedDict()  # {clave_cache: (origen, destino)}
+        self._lock = threading.Lock()
+        self._hilo = None
+    
+    def encolar(self, origen, destino):
+        """Agrega un par origen-destino a calentar (se descartan los más antiguos)"""
+        clave = _generar_clave_cache(origen, destino)
+        with self._lock:
+            if clave in self._pendientes:
+                return
+            if len(self._pendientes) >= self.max_pendientes:
+                self._pendientes.popitem(last=False)
+            self._pendientes[clave] = (origen, destino)
+    
+    def predecir(self, amb, ruta, instantanea):
+        """Encola las rutas desde las posiciones futuras de la ambulancia a sus mejores hospitales"""
+        if not ruta or not ruta.nodos or len(ruta.nodos) < 2:
+            return
+        paso = max(1, len(ruta.nodos) // 15)
+        posiciones = [ruta.nodos[i] for i in range(0, len(ruta.nodos), paso)]
+        # La última posición es donde la ambulancia espera la siguiente asignación
+        previstas = [posiciones[-1]]
+        restantes = posiciones[:-1]
+        if restantes and PREFETCH_POSICIONES > 1:
+            salto = max(1, len(restantes) // (PREFETCH_POSICIONES - 1))
+            previstas.extend(restantes[::-salto][:PREFETCH_POSICIONES - 1])
+        
+        disponibles = [h for h in instantanea.hospitales if h.puede_recibir()]
+        for lat, lon in previstas:
+            origen = Nodo(lat, lon)
+            candidatos = sorted(
+                disponibles,
+                key=lambda h: (amb.especialidad not in h.especialidades,
+                               calcular_distancia_km(origen, Nodo(h.lat, h.lon)))
+            )
+            for h in candidatos[:PREFETCH_HOSPITALES]:
+                self.encolar(origen, Nodo(h.lat, h.lon))
+    
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._ejecutar, daemon=True)
+            self._hilo.start()
+    
+    def _ejecutar(self):
+        while True:
+            time.sleep(self.intervalo)
+            peticiones = 0
+            while peticiones < self.presupuesto:
+                with self._lock:
+                    if not self._pendientes:
+                        break
+                    _, (origen, destino) = self._pendientes.popitem(last=False)
+                # Solo las rutas ausentes de la caché consumen presupuesto
+                if _obtener_de_cache(origen, destino):
+                    continue
+                peticiones += self._calentar(origen, destino, self.presupuesto - peticiones)
+    
+    def _calentar(self, origen, destino, disponibles):
+        """
+        Pide la ruta a los proveedores con una sola petición HTTP cada uno (sin
+        reintentos ni esperas). Retorna cuántas peticiones usó, nunca más de disponibles
+        """
+        resultado_subruta = SUBRUTAS.buscar(origen, destino)
+        if resultado_subruta and len(resultado_subruta[0]) > 2:
+            _guardar_en_cache(origen, destino, resultado_subruta)
+            return 0
+        
+        peticiones = 0
+        for servicio in (obtener_ruta_openrouteservice, obtener_ruta_graphhopper, obtener_ruta_osrm):
+            if peticiones >= disponibles:
+                break
+            peticiones += 1
+            try:
+                nodos_ruta, distancia, tiempo = servicio(origen, destino, max_retries=1)
+            except Exception:
+                continue
+            if nodos_ruta and len(nodos_ruta) > 2 and tiempo is not None and tiempo > 0:
+                _registrar_ruta_proveedor(origen, destino, (GEOMETRIAS.guardar(nodos_ruta), distancia, tiempo))
+                break
+        return peticiones
+
+PREFETCHER = PrefetcherRutas(PREFETCH_PRESUPUESTO, PREFETCH_INTERVALO, PREFETCH_MAX_PENDIENTES)
+
+# ----- TRANSMISIÓN DE POSICIONES POR TICK -----
+INTERVALO_POSICIONES = 0.5  # segundos entre frames; el cliente interpola entre ellos
+
+class TransmisorPosiciones:
+    """
+    Agrupa en un solo frame por tick las unidades que se movieron, como id de
+    geometría y fracción recorrida; el mapa interpola sobre la polilínea
+    """
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self._estado = {}   # {amb_id: (geometria_id, progreso)}
+        self._enviado = {}  # último estado transmitido de cada unidad
+        self._tick = 0
+        self._lock = threading.Lock()
+        self._hilo = None
+    
+    def actualizar(self, amb_id, geometria_id, progreso):
+        with self._lock:
+            self._estado[amb_id] = (geometria_id, round(progreso, 4))
+    
+    def frame(self, completo=False):
+        """Unidades que cambiaron desde el último tick (o todas, para un cliente nuevo)"""
+        with self._lock:
+            if completo:
+                unidades = dict(self._estado)
+            else:
+                unidades = {a: e for a, e in self._estado.items() if self._enviado.get(a) != e}
+                self._enviado.update(unidades)
+            tick = self._tick
+        return {
+            "tick": tick,
+            "intervalo": self.intervalo,
+            "unidades": [
+                {"ambulancia": amb_id, "ruta": geometria_id, "progreso": progreso}
+                for amb_id, (geometria_id, progreso) in unidades.items()
+            ]
+        }
+    
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._ejecutar, daemon=True)
+            self._hilo.start()
+    
+    def _ejecutar(self):
+        while True:
+            time.sleep(self.intervalo)
+            with self._lock:
+                self._tick += 1
+            frame = self.frame()
+            if frame["unidades"]:
+                # La flota versionada (la que sirve '/') se renueva una vez por tick, no por paso
+                ESTADO.publicar(ambulancias=[ambulancia_to_dict(a) for a in ambulancias])
+                emitir("update_posiciones", frame)
+
+TRANSMISOR = TransmisorPosiciones(INTERVALO_POSICIONES)
+
+# ----- REPLANIFICACIÓN INCREMENTAL -----
+REPLANIFICACION_INCREMENTAL = True
+PASOS_POR_TRAMO = 5            # pasos recorridos entre revisiones del plan
+UMBRAL_REPLANIFICACION = 0.15  # brecha relativa de costo que dispara la reevaluación
+FACTOR_DESVIO = 1.3            # distancia por vía / distancia en línea recta en ciudad
+TRAFICO_ESPERADO = 1.5         # factor medio de calcular_costo: 1 + 2 * U(0, 0.5)
+EJECUTOR_REPLANIFICACION = ThreadPoolExecutor(max_workers=4)
+
+RUTAS_ACTIVAS = {}  # {amb_id: payload de update_rutas} solo de los planes en curso
+RUTAS_ACTIVAS_LOCK = threading.Lock()
+
+def actualizar_ruta_activa(amb_id, info=None):
+    """Registra (o retira, si info es None) la ruta que sigue una ambulancia y difunde las vigentes"""
+    with RUTAS_ACTIVAS_LOCK:
+        if info is not None:
+            RUTAS_ACTIVAS[amb_id] = info
+        elif RUTAS_ACTIVAS.pop(amb_id, None) is None:
+            return
+        rutas = list(RUTAS_ACTIVAS.values())
+    emitir("update_rutas", rutas)
+
+def ruta_to_dict(amb_id, h, ruta, costo, nodos=None):
+    return {
+        "ambulancia": amb_id,
+        "hospital": h.nombre,
+        "color": colores[hash(amb_id) % len(colores)],
+        "geometria": GEOMETRIAS.guardar(ruta.nodos).id,
+        "nodos": nodos if nodos is not None else ruta.nodos.to_lista(),
+        "tiempo_total": costo
+    }
+
+def necesita_replanificar(amb, plan, instantanea):
+    """
+    Decide sin pedir rutas si vale la pena reevaluar el plan: el hospital ya no
+    recibe, su penalización empeoró más del umbral, o alguna alternativa tiene
+    un costo estimado (caché o red vial) claramente menor que el resto del plan
+    """
+    h_actual = next((h for h in instantanea.hospitales if h.nombre == plan.hospital.nombre), None)
+    if h_actual is None or not h_actual.puede_recibir():
+        return True
+    
+    previsto = plan.costo_restante()
+    actual = plan.costo_restante(penalizacion_hospital(amb, h_actual))
+    if previsto > 0 and (actual - previsto) / previsto > UMBRAL_REPLANIFICACION:
+        return True
+    
+    lat, lon = plan.nodo_siguiente()
+    origen = Nodo(lat, lon)
+    for h in instantanea.hospitales:
+        if h.nombre == h_actual.nombre or not h.puede_recibir():
+            continue
+        estimado = estimar_tiempo_min(origen, Nodo(h.lat, h.lon)) * TRAFICO_ESPERADO
+        if estimado + penalizacion_hospital(amb, h) < actual * (1 - UMBRAL_REPLANIFICACION):
+            return True
+    return False
+
+def estimar_tiempo_min(origen, destino):
+    """
+    Tiempo de viaje sin pedir rutas: el de la caché si ya se conoce la ruta, o
+    la distancia recta con desvío urbano a la velocidad promedio de la red vial
+    """
+    resultado_cache = _obtener_de_cache(origen, destino)
+    if resultado_cache and resultado_cache[2]:
+        return resultado_cache[2]
+    return calcular_distancia_km(origen, destino) * FACTOR_DESVIO / VELOCIDAD_PROMEDIO_KMH * 60
+
+@TRAZADOR.trazar()
+def reevaluar_plan(amb, plan, instantanea, indice):
+    """
+    Busca alternativas desde el nodo `indice` de la ruta del plan (puede correr
+    en segundo plano; no modifica el plan). Retorna la decisión:
+    ("mantener", penalizacion), ("cambiar", hospital, nodos_desde_indice, costo) o ("abandonar",)
+    """
+    h_actual = next((h for h in instantanea.hospitales if h.nombre == plan.hospital.nombre), None)
+    sigue_valido = h_actual is not None and h_actual.puede_recibir()
+    costo_actual = plan.costo_restante(penalizacion_hospital(amb, h_actual)) if sigue_valido else float('inf')
+    
+    lat, lon = plan.ruta.nodos[indice]
+    desde_indice = Ambulancia(amb.id, lat, lon, especialidad=amb.especialidad)
+    alternativas = [h for h in instantanea.hospitales if h.puede_recibir() and h.nombre != plan.hospital.nombre]
+    
+    arbol = ArbolBinarioBusqueda()
+    if alternativas:
+        with ThreadPoolExecutor(max_workers=min(len(alternativas), 6)) as executor:
+            for resultado in executor.map(lambda h: evaluar_hospital(desde_indice, h), alternativas):
+                if resultado is not None:
+                    h, nodos_ruta, costo = resultado
+                    arbol.insertar((h, nodos_ruta), costo)
+    
+    if not arbol.esta_vacio():
+        (mejor_h, nodos_ruta), mejor_costo = arbol.obtener_menor()
+        if mejor_costo < costo_actual * (1 - UMBRAL_REPLANIFICACION):
+            print(f"[REPLAN] {amb.id}: {plan.hospital.nombre} -> {mejor_h.nombre} ({costo_actual:.1f} -> {mejor_costo:.1f})")
+            return ("cambiar", mejor_h, [[lat, lon] for lat, lon in nodos_ruta], mejor_costo)
+    
+    if not sigue_valido:
+        # Sin alternativa ni hospital válido: se abandona el plan y se hace una asignación completa
+        return ("abandonar",)
+    return ("mantener", penalizacion_hospital(amb, h_actual))
+
+def aplicar_reevaluacion(amb, plan, decision, indice, instantanea):
+    """
+    Aplica la decisión de reevaluar_plan en el hilo de la ambulancia. Un plan
+    nuevo conserva el tramo de la ruta actual que falta hasta el nodo `indice`
+    Retorna el plan a seguir, o None si hay que hacer una asignación completa
+    """
+    if decision[0] == "abandonar":
+        return None
+    if decision[0] == "mantener":
+        # El sufijo sigue siendo óptimo para el mismo hospital: se reutiliza con la penalización actual
+        plan.penalizacion = decision[1]
+        return plan
+    
+    _, mejor_h, nodos_ruta, mejor_costo = decision
+    puente = plan.ruta.nodos[plan.cursor:indice].to_lista() if plan.cursor < indice else []
+    nodos = GEOMETRIAS.guardar([[amb.pos.lat, amb.pos.lon]] + puente + nodos_ruta)
+    ruta = Ruta(nodos, round(mejor_costo, 1))
+    amb.historial.agregar_final({
+        "hospital": mejor_h.nombre,
+        "tiempo": round(mejor_costo, 1),
+        "timestamp": time.time(),
+        "ruta": nodos,
+        "replanificada": True
+    })
+    actualizar_ruta_activa(amb.id, ruta_to_dict(amb.id, mejor_h, ruta, round(mejor_costo, 1)))
+    if PREFETCH_ACTIVO:
+        PREFETCHER.predecir(amb, ruta, instantanea)
+    return PlanRuta(mejor_h, ruta, mejor_costo, penalizacion_hospital(amb, mejor_h))
+
+def replanificar_incremental(amb, plan, instantanea):
+    """
+    Mantiene el plan mientras siga siendo bueno. Si hay que reevaluar, busca
+    solo desde el siguiente nodo de la ruta y conserva el sufijo restante salvo
+    que otro hospital mejore el costo por encima del umbral (versión síncrona)
+    """
+    if not necesita_replanificar(amb, plan, instantanea):
+        return plan
+    indice = plan.cursor
+    return aplicar_reevaluacion(amb, plan, reevaluar_plan(amb, plan, instantanea, indice), indice, instantanea)
+
+def iniciar_reevaluacion(amb, plan, instantanea):
+    """
+    Lanza reevaluar_plan en segundo plano desde el nodo donde la ambulancia
+    terminará el tramo actual, para no detener el recorrido mientras responden
+    los proveedores. Retorna (futuro, indice)
+    """
+    indice = min(plan.cursor + plan.paso * PASOS_POR_TRAMO, len(plan.ruta.nodos) - 1)
+    return EJECUTOR_REPLANIFICACION.submit(reevaluar_plan, amb, plan, instantanea, indice), indice
+
+def recorrer_plan(amb, plan, max_pasos=None, mision=False):
+    # La posición se publica en el transmisor; no se emite un mensaje por paso
+    geometria_id = GEOMETRIAS.guardar(plan.ruta.nodos).id
+    pasos = 0
+    # Una unidad reservada para un incidente deja de seguir su plan (salvo la propia misión)
+    while not plan.terminado() and (mision or amb.disponible()) and (max_pasos is None or pasos < max_pasos):
+        nodo = plan.avanzar()
+        amb.pos.lat, amb.pos.lon = nodo[0], nodo[1]
+        TRANSMISOR.actualizar(amb.id, geometria_id, plan.progreso())
+        
+        time.sleep(0.2)
+        pasos += 1
+
+# ----- RED VIAL Y DESPACHO DE INCIDENTES -----
+# Grafo compartido construido con los tramos de todas las rutas reales obtenidas
+RED_VIAL = Grafo()
+RED_VIAL_LOCK = threading.Lock()
+VELOCIDAD_PROMEDIO_KMH = 30    # misma velocidad que Via.calcular_peso
+TOLERANCIA_AJUSTE_KM = 0.3     # distancia máxima para ajustar un punto a la red
+RESERVA_INCIDENTE_SEG = 120    # tiempo extra que la unidad elegida queda reservada
+INCIDENTES_K = 3
+INCIDENTES_MAX_K = 10          # cota de candidatos que puede pedir un cliente
+
+CONTADOR_INCIDENTES = itertools.count(1)
+MISIONES = {}  # {amb_id: (hospital, ruta incidente -> hospital, costo)} pendientes de recorrer
+MISIONES_LOCK = threading.Lock()
+EJECUTOR_INCIDENTES = ThreadPoolExecutor(max_workers=4)
+DESPACHO_LOCK = threading.Lock()  # elegir y reservar una unidad es una sola operación
+
+def incorporar_a_red_vial(nodos_ruta):
+    """Agrega los nodos y tramos de una ruta real a la red vial compartida"""
+    with RED_VIAL_LOCK:
+        previo = None
+        for lat, lon in nodos_ruta:
+            # Las rutas que pasan por el mismo punto de la vía comparten nodo
+            nodo = RED_VIAL.agregar_nodo(f"{lat:.5f},{lon:.5f}", lat, lon)
+            if previo is not None and previo is not nodo:
+                distancia = calcular_distancia_km(previo, nodo)
+                # Las rutas no informan sentidos de circulación: se asume doble sentido
+                RED_VIAL.agregar_arista(previo.id, nodo.id, distancia)
+                RED_VIAL.agregar_arista(nodo.id, previo.id, distancia)
+            previo = nodo
+
+def _ajustar_a_red(lat, lon):
+    # Requiere RED_VIAL_LOCK; retorna (nodo_id, distancia_km) o None
+    cercanos = RED_VIAL.nodos_cercanos(lat, lon, 1, radio_max_km=TOLERANCIA_AJUSTE_KM)
+    if not cercanos:
+        return None
+    distancia, nodo = cercanos[0]
+    return nodo.id, distancia
+
+def _ajustar_a_tramo(lat, lon):
+    """
+    Requiere RED_VIAL_LOCK. Proyecta el punto sobre el tramo más cercano (los
+    vértices de una polilínea pueden estar muy separados en vías rectas)
+    Retorna ({nodo_id: costo hasta el punto proyectado}, distancia_km) o None
+    """
+    ajuste = RED_VIAL.ajustar_a_arista(lat, lon)
+    if ajuste is None or ajuste[3] > TOLERANCIA_AJUSTE_KM:
+        return None
+    origen_id, destino_id, fraccion, distancia = ajuste
+    largo = RED_VIAL.nodos[origen_id].adyacentes.get(destino_id, 0)
+    extremos = {origen_id: fraccion * largo}
+    extremos[destino_id] = min(extremos.get(destino_id, float('inf')), (1 - fraccion) * largo)
+    return extremos, distancia
+
+@TRAZADOR.trazar()
+def despachar_incidente(lat, lon, k=INCIDENTES_K):
+    """
+    Busca en una sola pasada (Dijkstra inverso multi-origen desde el incidente)
+    las k ambulancias libres más cercanas por la red vial
+    Retorna: [{"ambulancia", "eta_min", "distancia_km", "ruta"}, ...]
+    """
+    libres = {amb_id: a for amb_id, a in FLOTA.items() if a.disponible()}
+    with RED_VIAL_LOCK:
+        ajuste_incidente = _ajustar_a_tramo(lat, lon)
+        if ajuste_incidente is None:
+            return []
+        extremos_incidente, acceso_incidente = ajuste_incidente
+        origenes = {}
+        for amb_id, amb in libres.items():
+            ajuste = _ajustar_a_red(amb.pos.lat, amb.pos.lon)
+            if ajuste is not None:
+                origenes[amb_id] = ajuste
+        resultados = RED_VIAL.busqueda_inversa_multiorigen(extremos_incidente, origenes, k)
+    
+    candidatos = []
+    for distancia, amb_id, camino in resultados:
+        distancia_total = distancia + acceso_incidente
+        candidatos.append({
+            "ambulancia": amb_id,
+            "especialidad": libres[amb_id].especialidad,
+            "eta_min": round(distancia_total / VELOCIDAD_PROMEDIO_KMH * 60, 1),
+            "distancia_km": round(distancia_total, 3),
+            "ruta": camino + [[lat, lon]]
+        })
+    return candidatos
+
+def asignar_hospital_incidente(incidente, candidato):
+    """
+    Encadena la asignación de hospital desde el lugar del incidente para la
+    unidad elegida y le deja la misión (incidente -> hospital) a su hilo
+    """
+    amb = FLOTA.get(candidato["ambulancia"])
+    if amb is None:
+        return
+    en_incidente = Ambulancia(amb.id, incidente["lat"], incidente["lon"], especialidad=amb.especialidad)
+    asignaciones = asignar_hospitales_dijkstra([en_incidente], ESTADO.actual().hospitales)
+    if amb.id not in asignaciones:
+        # Sin hospital no hay traslado que simular: la unidad vuelve a quedar libre
+        amb.liberar()
+        emitir("incidente_asignado", {"incidente": incidente["id"], "ambulancia": amb.id, "hospital": None})
+        return
+    h, ruta, costo = asignaciones[amb.id]
+    amb.historial.agregar_final(dict(en_incidente.historial.obtener(0), incidente=incidente["id"]))
+    with MISIONES_LOCK:
+        MISIONES[amb.id] = (h, candidato["ruta"] + ruta.nodos.to_lista()[1:], candidato["eta_min"] + costo)
+    emitir("incidente_asignado", {
+        "incidente": incidente["id"],
+        "ambulancia": amb.id,
+        "ruta_incidente": candidato["ruta"],
+        "hospital": h.nombre,
+        "ruta_hospital": ruta.nodos.to_lista(),
+        "tiempo_total": costo
+    })
+
+def procesar_incidente(lat, lon, k=INCIDENTES_K):
+    """Despacha la unidad más cercana, la reserva y encadena la asignación de hospital en segundo plano"""
+    incidente = {"id": next(CONTADOR_INCIDENTES), "lat": lat, "lon": lon, "timestamp": time.time()}
+    # Sin el lock, dos incidentes simultáneos podrían ver libre y despachar la misma unidad
+    with DESPACHO_LOCK:
+        candidatos = despachar_incidente(lat, lon, k)
+        if candidatos:
+            elegido = candidatos[0]
+            amb = FLOTA.get(elegido["ambulancia"])
+            if amb is not None:
+                amb.reservar(elegido["eta_min"] * 60 + RESERVA_INCIDENTE_SEG)
+    if candidatos:
+        EJECUTOR_INCIDENTES.submit(asignar_hospital_incidente, incidente, elegido)
+    return {"incidente": incidente, "candidatos": candidatos}
+
+def tomar_mision(amb):
+    """
+    Si la unidad tiene una misión pendiente, la convierte en un plan que parte de
+    su posición actual (pudo avanzar un paso después del despacho)
+    """
+    with MISIONES_LOCK:
+        mision = MISIONES.pop(amb.id, None)
+    if mision is None:
+        return None
+    h, nodos, costo = mision
+    ruta = Ruta(GEOMETRIAS.guardar([[amb.pos.lat, amb.pos.lon]] + nodos), round(costo, 1))
+    return PlanRuta(h, ruta, costo)
+
+def _leer_incidente(datos):
+    # Retorna (lat, lon, k) o None si la solicitud es inválida
+    try:
+        lat, lon = float(datos["lat"]), float(datos["lon"])
+        k = int(datos.get("k", INCIDENTES_K))
+    except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
+        return None
+    if not math.isfinite(lat) or not math.isfinite(lon):
+        return None
+    return lat, lon, max(1, min(k, INCIDENTES_MAX_K))
+
 # ----- FLASK ROUTES -----
 @app.route('/favicon.ico')
 def favicon():
@@ -431,34 +1111,149 @@ def favicon():
 
 @app.route('/')
 def index():
-    global ambulancias
-    ambulancias = [
-        Ambulancia("AMB-001", *generar_ubicacion_aleatoria(), especialidad="Cardiología"),
-        Ambulancia("AMB-002", *generar_ubicacion_aleatoria(), especialidad="Trauma"),
-        Ambulancia("AMB-003", *generar_ubicacion_aleatoria(), especialidad="General")
-    ]
-    
-    amb_json = [ambulancia_to_dict(a) for a in ambulancias]
-    hosp_json = [hospital_to_dict(h) for h in hospitales]
+    # La flota es la misma que simulan los hilos: no se recrea al cargar la página y
+    # se sirve la versión publicada por el transmisor (payload en caché por versión)
+    instantanea = ESTADO.actual()
+    amb_json = instantanea.serializar("ambulancias", ambulancias_json)
+    hosp_json = instantanea.serializar("hospitales", hospitales_json)
     
     return render_template("index.html",
                            ambulancias=amb_json,
                            hospitales=hosp_json)
 
+@app.route('/incidentes', methods=['POST'])
+def crear_incidente():
+    solicitud = _leer_incidente(request.get_json(silent=True))
+    if solicitud is None:
+        return jsonify({"error": "Se requieren lat y lon numéricos"}), 400
+    return jsonify(procesar_incidente(*solicitud))
+
+@socketio.on("connect")
+def cliente_conectado(auth=None):
+    # Un cliente nuevo recibe de inmediato la posición de todas las unidades
+    frame = TRANSMISOR.frame(completo=True)
+    if frame["unidades"]:
+        emit("update_posiciones", frame)
+
+@socketio.on("solicitar_geometria")
+def solicitar_geometria(geometria_id):
+    """Polilínea de una geometría que el cliente aún no conoce"""
+    if not isinstance(geometria_id, str):
+        emit("geometria", {"id": None, "nodos": None})
+        return
+    geometria = GEOMETRIAS.obtener(geometria_id)
+    if geometria is not None:
+        nodos = geometria.to_lista()
+    else:
+        # Expulsada del almacén LRU: la ruta en curso conserva sus nodos
+        with RUTAS_ACTIVAS_LOCK:
+            nodos = next((r["nodos"] for r in RUTAS_ACTIVAS.values() if r["geometria"] == geometria_id), None)
+    emit("geometria", {"id": geometria_id, "nodos": nodos})
+
+@socketio.on("nuevo_incidente")
+def nuevo_incidente(datos):
+    solicitud = _leer_incidente(datos)
+    if solicitud is None:
+        emit("incidente_despachado", {"error": "Se requieren lat y lon numéricos"})
+        return
+    emit("incidente_despachado", procesar_incidente(*solicitud))
+
+# ----- TRAZAS (CONTROL EN CALIENTE) -----
+@app.route('/trazas', methods=['GET'])
+def trazas_estado():
+    return jsonify(TRAZADOR.estado())
+
+@app.route('/trazas/<accion>', methods=['POST'])
+def trazas_control(accion):
+    acciones = {
+        "activar": TRAZADOR.activar,
+        "desactivar": TRAZADOR.desactivar,
+        "muestreo": TRAZADOR.iniciar_muestreo,
+        "detener-muestreo": TRAZADOR.detener_muestreo,
+        "limpiar": TRAZADOR.limpiar
+    }
+    if accion not in acciones:
+        return jsonify({"error": f"Acción desconocida: {accion}"}), 404
+    acciones[accion]()
+    return jsonify(TRAZADOR.estado())
+
+@app.route('/trazas/chrome.json')
+def trazas_chrome():
+    return jsonify(TRAZADOR.exportar_chrome())
+
+@app.route('/trazas/flamegraph.txt')
+def trazas_flamegraph():
+    fuente = request.args.get("fuente", "spans")
+    return Response(TRAZADOR.exportar_flamegraph(fuente=fuente), mimetype="text/plain")
+
 # ----- SIMULACIÓN -----
 def actualizar_estado_hospitales():
-    for h in hospitales:
-        h.tiempo_espera = random.randint(2, 8)
-        h.pacientes_actuales = random.randint(0, int(h.capacidad_max * 0.8))
+    # Copia en escritura: nunca se modifican los hospitales ya publicados
+    previa = ESTADO.actual()
+    return ESTADO.publicar(hospitales=[
+        h.copiar(
+            tiempo_espera=random.randint(2, 8),
+            pacientes_actuales=random.randint(0, int(h.capacidad_max * 0.8))
+        )
+        for h in previa.hospitales
+    ])
 
 def simular_ambulancia(amb):
+    plan = None
+    reevaluacion = None  # (futuro, indice, instantanea, plan evaluado) en segundo plano
     while True:
         try:
-            actualizar_estado_hospitales()
+            if not amb.disponible() or amb.id in MISIONES:
+                # Reservada para un incidente: queda fuera de la asignación periódica
+                # y recorre la misión (incidente -> hospital) en cuanto está lista
+                plan = None
+                reevaluacion = None
+                mision = tomar_mision(amb)
+                if mision is None:
+                    actualizar_ruta_activa(amb.id)
+                    time.sleep(1)
+                    continue
+                actualizar_ruta_activa(amb.id, ruta_to_dict(amb.id, mision.hospital, mision.ruta, mision.ruta.tiempo_total))
+                recorrer_plan(amb, mision, mision=True)
+                amb.liberar()
+                actualizar_ruta_activa(amb.id)
+                time.sleep(3)
+                continue
             
-            asignaciones = asignar_hospitales_dijkstra(ambulancias, hospitales)
+            if REPLANIFICACION_INCREMENTAL and plan is not None and not plan.terminado():
+                if reevaluacion is not None and reevaluacion[3] is not plan:
+                    reevaluacion = None  # el plan evaluado ya no está en curso
+                if reevaluacion is not None and reevaluacion[0].done():
+                    futuro, indice, instantanea, _ = reevaluacion
+                    reevaluacion = None
+                    try:
+                        plan = aplicar_reevaluacion(amb, plan, futuro.result(), indice, instantanea)
+                    except Exception:
+                        pass
+                    if plan is None:
+                        actualizar_ruta_activa(amb.id)
+                        continue
+                elif reevaluacion is None:
+                    instantanea = ESTADO.actual()
+                    if necesita_replanificar(amb, plan, instantanea):
+                        reevaluacion = iniciar_reevaluacion(amb, plan, instantanea) + (instantanea, plan)
+                
+                # El recorrido sigue mientras los proveedores responden la reevaluación
+                recorrer_plan(amb, plan, PASOS_POR_TRAMO)
+                if not plan.terminado():
+                    continue
+                plan = None
+                reevaluacion = None
+                actualizar_ruta_activa(amb.id)
+                time.sleep(3)
+                continue
+            
+            instantanea = actualizar_estado_hospitales()
+            emitir("update_hospitales", instantanea.serializar("hospitales", hospitales_json))
+            
+            # Toda la asignación usa la misma vista consistente de los hospitales
+            asignaciones = asignar_hospitales_dijkstra([a for a in ambulancias if a.disponible()], instantanea.hospitales)
             print(f"[SIMULACION] Asignaciones obtenidas: {len(asignaciones)}")
-            rutas_info = []
             grafo_info = []
 
             for amb_id, (h, ruta, costo) in asignaciones.items():
@@ -467,51 +1262,44 @@ def simular_ambulancia(amb):
                     print(f"[SIMULACION] Saltando {amb_id} -> {h.nombre}: ruta inválida o muy corta")
                     continue
                     
-                color = colores[hash(amb_id) % len(colores)]
-                rutas_info.append({
-                    "ambulancia": amb_id,
-                    "hospital": h.nombre,
-                    "color": color,
-                    "nodos": ruta.nodos,
-                    "tiempo_total": costo
-                })
+                # Una sola lista serializable compartida por ambos payloads
+                nodos = ruta.nodos.to_lista()
+                info = ruta_to_dict(amb_id, h, ruta, costo, nodos)
+                color = info["color"]
+                if amb_id == amb.id:
+                    # Las demás unidades siguen su propio plan; solo se publica la ruta que se recorrerá
+                    actualizar_ruta_activa(amb_id, info)
                 
-                origen_amb = next((a for a in ambulancias if a.id == amb_id), None)
+                origen_amb = FLOTA.get(amb_id)
                 if origen_amb and ruta.nodos and len(ruta.nodos) > 2:
                     grafo_info.append({
                         "origen": {"lat": origen_amb.pos.lat, "lon": origen_amb.pos.lon, "id": amb_id},
                         "destino": {"lat": h.lat, "lon": h.lon, "id": h.nombre},
-                        "ruta": ruta.nodos,
+                        "ruta": nodos,
                         "color": color
                     })
                     print(f"[GRAFO] Enviando grafo: {amb_id} -> {h.nombre} con {len(ruta.nodos)} nodos")
 
-            if rutas_info:
-                print(f"[SIMULACION] Enviando {len(rutas_info)} rutas al cliente")
-                socketio.emit("update_rutas", rutas_info)
             if grafo_info:
                 print(f"[GRAFO] Enviando {len(grafo_info)} grafos al cliente")
-                socketio.emit("update_grafo", grafo_info)
+                emitir("update_grafo", grafo_info)
             else:
                 print(f"[GRAFO] No hay grafos para enviar")
             
             if amb.id in asignaciones:
-                h, ruta, _ = asignaciones[amb.id]
+                h, ruta, costo = asignaciones[amb.id]
                 
                 if ruta and ruta.nodos and len(ruta.nodos) >= 2:
-                    paso = max(1, len(ruta.nodos) // 15)
-                    for i in range(0, len(ruta.nodos), paso):
-                        nodo = ruta.nodos[i]
-                        amb.pos.lat, amb.pos.lon = nodo[0], nodo[1]
-                        
-                        socketio.emit("update_position", {
-                            "ambulancia": amb.id,
-                            "lat": amb.pos.lat,
-                            "lon": amb.pos.lon,
-                            "hospital": h.nombre
-                        })
-                        
-                        time.sleep(0.2)
+                    if PREFETCH_ACTIVO:
+                        PREFETCHER.predecir(amb, ruta, instantanea)
+                    
+                    plan = PlanRuta(h, ruta, costo, penalizacion_hospital(amb, h))
+                    # En modo incremental se recorre por tramos, revisando el plan entre ellos
+                    recorrer_plan(amb, plan, PASOS_POR_TRAMO if REPLANIFICACION_INCREMENTAL else None)
+                    if not plan.terminado():
+                        continue
+                    plan = None
+                    actualizar_ruta_activa(amb.id)
             
             time.sleep(3)
         except KeyboardInterrupt:
@@ -521,6 +1309,9 @@ def simular_ambulancia(amb):
 
 def iniciar_simulacion():
     time.sleep(2)
+    TRANSMISOR.iniciar()
+    if PREFETCH_ACTIVO:
+        PREFETCHER.iniciar()
     for amb in ambulancias:
         thread = threading.Thread(target=simular_ambulancia, args=(amb,), daemon=True)
         thread.start()
@@ -529,7 +1320,8 @@ def iniciar_simulacion():
 if __name__ == '__main__':
     try:
         threading.Thread(target=iniciar_simulacion, daemon=True).start()
-        socketio.run(app, debug=False, host='127.0.0.1', port=5000, allow_unsafe_werkzeug=True)
+        opciones = {'allow_unsafe_werkzeug': True} if ASYNC_MODE == 'threading' else {}
+        socketio.run(app, debug=False, host='127.0.0.1', port=5000, **opciones)
     except KeyboardInterrupt:
         pass
     except Exception as e:
@@ -0,0 +1,501 @@
+"""
+Prueba de carga del fan-out de Socket.IO con muchos clientes de mapa simulados.
+
+Levanta el simulador en un subproceso por cada modo asíncrono disponible, con
+un enrutador determinista en lugar de las APIs externas, conecta cientos o
+miles de clientes Socket.IO locales y mide latencia de extremo a extremo de
+los emits, pérdida de mensajes y CPU / memoria del servidor.
+
+Uso:
+    python carga.py --clientes 500 --duracion 30
+    python carga.py --modos threading,eventlet,gevent --clientes 1000 --procesos 8
+
+También incluye un servidor de rutas local compatible con OSRM (/route y /table)
+para probar el simulador sin APIs externas:
+    python carga.py --servidor-rutas --puerto 5100
+    SIMULADOR_OSRM_URL=http://127.0.0.1:5100 SIMULADOR_ORS_URL=http://127.0.0.1:5100 \
+        SIMULADOR_GRAPHHOPPER_URL=http://127.0.0.1:5100 python app.py
+"""
+import sys
+
+# eventlet/gevent deben parchear antes de importar threading, ssl, requests o socketio,
+# por eso el modo del subproceso servidor se lee de sys.argv antes de cualquier otro import
+if "--servidor" in sys.argv and "--modo" in sys.argv[:-1]:
+    _MODO_SERVIDOR = sys.argv[sys.argv.index("--modo") + 1]
+    if _MODO_SERVIDOR == "eventlet":
+        import eventlet
+        eventlet.monkey_patch()
+    elif _MODO_SERVIDOR == "gevent":
+        from gevent import monkey
+        monkey.patch_all()
+
+import os
+import json
+import time
+import math
+import random
+import argparse
+import threading
+import importlib.util
+import subprocess
+import multiprocessing
+from collections import Counter, deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import requests
+    import socketio
+except ImportError as e:
+    print(f"Error: Faltan dependencias. Ejecuta: pip install flask flask-socketio requests websocket-client")
+    sys.exit(1)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MODOS_ASYNC = ["threading", "eventlet", "gevent"]
+EVENTOS = ["update_posiciones", "update_rutas", "update_grafo", "update_hospitales"]
+EVENTO_MARCA = "carga_marca"  # lleva _seq y _t de los eventos cuyo payload no es un dict
+
+def modos_disponibles(modos):
+    return [m for m in modos if m == "threading" or importlib.util.find_spec(m) is not None]
+
+# ----- LADO SERVIDOR -----
+def ruta_simulada(origen, destino, max_retries=1):
+    """Enrutador determinista: polilínea en L con un punto cada ~50 m a 30 km/h"""
+    puntos = []
+    tramos = [((origen.lat, origen.lon), (destino.lat, origen.lon)),
+              ((destino.lat, origen.lon), (destino.lat, destino.lon))]
+    distancia_km = 0
+    for (lat1, lon1), (lat2, lon2) in tramos:
+        largo = math.hypot(lat2 - lat1, (lon2 - lon1) * math.cos(math.radians(lat1))) * 111.32
+        distancia_km += largo
+        pasos = max(2, int(largo / 0.05))
+        for i in range(pasos):
+            puntos.append([lat1 + (lat2 - lat1) * i / pasos, lon1 + (lon2 - lon1) * i / pasos])
+    puntos.append([destino.lat, destino.lon])
+    tiempo_min = max(distancia_km / 30 * 60, 0.1)
+    return puntos, distancia_km, tiempo_min
+
+def matriz_simulada(origenes, destinos, max_retries=1):
+    """Matriz de duraciones (min) coherente con ruta_simulada"""
+    return [[ruta_simulada(o, d)[2] for d in destinos] for o in origenes]
+
+# ----- SERVIDOR DE RUTAS LOCAL (COMPATIBLE CON OSRM) -----
+class _Punto:
+    def __init__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+
+class ManejadorRutas(BaseHTTPRequestHandler):
+    """Responde /route/v1/driving y /table/v1/driving con el enrutador determinista"""
+    contadores = Counter()
+
+    def _responder(self, codigo, datos):
+        cuerpo = json.dumps(datos).encode()
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        partes = url.path.strip("/").split("/")
+        if url.path == "/contadores":
+            return self._responder(200, dict(self.contadores))
+        if len(partes) != 4 or partes[0] not in ("route", "table"):
+            return self._responder(404, {"code": "InvalidUrl"})
+        try:
+            puntos = [_Punto(float(c.split(",")[1]), float(c.split(",")[0])) for c in partes[3].split(";")]
+        except (IndexError, ValueError):
+            return self._responder(400, {"code": "InvalidQuery"})
+        self.contadores[partes[0]] += 1
+
+        if partes[0] == "route":
+            nodos, distancia_km, tiempo_min = ruta_simulada(puntos[0], puntos[-1])
+            return self._responder(200, {"code": "Ok", "routes": [{
+                "geometry": {"type": "LineString", "coordinates": [[lon, lat] for lat, lon in nodos]},
+                "distance": distancia_km * 1000,
+                "duration": tiempo_min * 60
+            }]})
+
+        params = parse_qs(url.query)
+        def indices(nombre):
+            valor = params.get(nombre, ["all"])[0]
+            return list(range(len(puntos))) if valor == "all" else [int(i) for i in valor.split(";")]
+        fuentes, destinos = indices("sources"), indices("destinations")
+        duraciones = matriz_simulada([puntos[i] for i in fuentes], [puntos[j] for j in destinos])
+        return self._responder(200, {"code": "Ok", "durations": [[d * 60 for d in fila] for fila in duraciones]})
+
+    def do_POST(self):
+        # Rutas de OpenRouteService y GraphHopper: no soportadas, el simulador pasa a OSRM
+        self._responder(404, {"error": "no soportado"})
+
+    def log_message(self, formato, *args):
+        pass
+
+def ejecutar_servidor_rutas(puerto):
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), ManejadorRutas)
+    print(f"[RUTAS] Servidor de rutas simulado en http://127.0.0.1:{puerto}")
+    servidor.serve_forever()
+
+def ejecutar_servidor(modo, puerto, num_ambulancias):
+    """Arranca el simulador instrumentado (se ejecuta dentro del subproceso, ya parcheado)"""
+    os.environ["SIMULADOR_ASYNC_MODE"] = modo
+    random.seed(0)
+    import app as simulador
+
+    for nombre in ("obtener_ruta_openrouteservice", "obtener_ruta_graphhopper", "obtener_ruta_osrm"):
+        setattr(simulador, nombre, ruta_simulada)
+    for nombre in ("obtener_matriz_openrouteservice", "obtener_matriz_osrm"):
+        setattr(simulador, nombre, matriz_simulada)
+
+    especialidades = ["Cardiología", "Trauma", "General"]
+    for i in range(len(simulador.ambulancias), num_ambulancias):
+        simulador.registrar_ambulancia(simulador.Ambulancia(
+            f"AMB-{i + 1:03d}", *simulador.generar_ubicacion_aleatoria(),
+            especialidad=especialidades[i % len(especialidades)]
+        ))
+
+    # Numera cada emit y sella la hora de envío: dentro del payload si es un dict,
+    # o en un evento carga_marca emitido justo después si es una lista
+    enviados = Counter()
+    lock = threading.Lock()
+    emitir_original = simulador.emitir
+
+    def emitir_medido(evento, datos):
+        with lock:
+            enviados[evento] += 1
+            seq = enviados[evento]
+        enviado = time.time()
+        if isinstance(datos, dict):
+            emitir_original(evento, dict(datos, _seq=seq, _t=enviado))
+        else:
+            emitir_original(evento, datos)
+            emitir_original(EVENTO_MARCA, {"evento": evento, "_seq": seq, "_t": enviado})
+
+    simulador.emitir = emitir_medido
+
+    @simulador.socketio.on("carga_estadisticas")
+    def carga_estadisticas():
+        with lock:
+            return dict(enviados)
+
+    threading.Thread(target=simulador.iniciar_simulacion, daemon=True).start()
+    opciones = {"allow_unsafe_werkzeug": True} if modo == "threading" else {}
+    simulador.socketio.run(simulador.app, host="127.0.0.1", port=puerto, **opciones)
+
+# ----- CLIENTES -----
+class ClienteMapa:
+    """Cliente Socket.IO que imita un mapa y registra lo que recibe"""
+    def __init__(self):
+        self.sio = socketio.Client(reconnection=False)
+        self.midiendo = False
+        self.recibidos = Counter()
+        self.latencias = {}  # {evento: [segundos]}
+        self.seqs = {}  # {evento: set(seq)}
+        self._llegadas = {evento: deque() for evento in EVENTOS}  # payloads sin marca aún
+        for evento in EVENTOS:
+            self.sio.on(evento, self._manejador(evento))
+        self.sio.on(EVENTO_MARCA, self._marca)
+
+    def _manejador(self, evento):
+        def manejar(datos):
+            if not self.midiendo:
+                return
+            llegada = time.time()
+            self.recibidos[evento] += 1
+            if isinstance(datos, dict) and "_t" in datos:
+                self._registrar(evento, datos["_seq"], llegada - datos["_t"])
+            else:
+                self._llegadas[evento].append(llegada)
+        return manejar
+
+    def _marca(self, datos):
+        # La marca sigue a su payload por la misma conexión: se empareja con la
+        # llegada más antigua sin marca de ese evento
+        llegadas = self._llegadas.get(datos.get("evento"))
+        if not self.midiendo or not llegadas:
+            return
+        self._registrar(datos["evento"], datos["_seq"], llegadas.popleft() - datos["_t"])
+
+    def _registrar(self, evento, seq, latencia):
+        self.latencias.setdefault(evento, []).append(latencia)
+        self.seqs.setdefault(evento, set()).add(seq)
+
+    def perdidos(self):
+        """Huecos en la numeración de cada evento: {evento: (esperados, perdidos)}"""
+        resultado = {}
+        for evento, seqs in self.seqs.items():
+            total = max(seqs) - min(seqs) + 1
+            resultado[evento] = (total, total - len(seqs))
+        return resultado
+
+def ejecutar_clientes(url, cantidad, inicio, fin, transporte):
+    """Conecta 'cantidad' clientes, mide entre inicio y fin y devuelve un resumen (proceso hijo)"""
+    clientes = []
+    fallidos = 0
+    for _ in range(cantidad):
+        cliente = ClienteMapa()
+        try:
+            cliente.sio.connect(url, transports=[transporte], wait_timeout=10)
+            clientes.append(cliente)
+        except Exception:
+            fallidos += 1
+
+    time.sleep(max(0, inicio - time.time()))
+    for cliente in clientes:
+        cliente.midiendo = True
+    time.sleep(max(0, fin - time.time()))
+    for cliente in clientes:
+        cliente.midiendo = False
+
+    recibidos = Counter()
+    latencias = {}
+    esperados = Counter()
+    perdidos = Counter()
+    for cliente in clientes:
+        recibidos.update(cliente.recibidos)
+        for evento, valores in cliente.latencias.items():
+            latencias.setdefault(evento, []).extend(valores)
+        for evento, (e, p) in cliente.perdidos().items():
+            esperados[evento] += e
+            perdidos[evento] += p
+        try:
+            cliente.sio.disconnect()
+        except Exception:
+            pass
+    return {
+        "conectados": len(clientes),
+        "fallidos": fallidos,
+        "recibidos": dict(recibidos),
+        "latencias": latencias,
+        "esperados_seq": dict(esperados),
+        "perdidos_seq": dict(perdidos)
+    }
+
+# ----- MONITOR DEL SERVIDOR -----
+class MonitorProceso:
+    """Muestrea CPU (%) y memoria residente (MB) de un proceso"""
+    def __init__(self, pid, intervalo=0.5):
+        self.pid = pid
+        self.intervalo = intervalo
+        self.cpu = []
+        self.rss = []
+        self._activo = False
+        self._hilo = None
+
+    def _leer(self):
+        """Retorna (segundos de CPU acumulados, RSS en MB)"""
+        if psutil is not None:
+            proceso = psutil.Process(self.pid)
+            tiempos = proceso.cpu_times()
+            return tiempos.user + tiempos.system, proceso.memory_info().rss / 1e6
+        with open(f"/proc/{self.pid}/stat") as archivo:
+            campos = archivo.read().rsplit(")", 1)[1].split()
+        cpu = (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")
+        rss = 0
+        with open(f"/proc/{self.pid}/status") as archivo:
+            for linea in archivo:
+                if linea.startswith("VmRSS:"):
+                    rss = int(linea.split()[1]) / 1000
+        return cpu, rss
+
+    def iniciar(self):
+        self._activo = True
+        self._hilo = threading.Thread(target=self._ejecutar, daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._activo = False
+        if self._hilo:
+            self._hilo.join()
+
+    def _ejecutar(self):
+        try:
+            cpu_previo, _ = self._leer()
+            t_previo = time.time()
+            while self._activo:
+                time.sleep(self.intervalo)
+                cpu, rss = self._leer()
+                ahora = time.time()
+                self.cpu.append((cpu - cpu_previo) / (ahora - t_previo) * 100)
+                self.rss.append(rss)
+                cpu_previo, t_previo = cpu, ahora
+        except (OSError, ValueError):
+            pass
+
+# ----- ORQUESTACIÓN -----
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def esperar_servidor(url, timeout=60):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        try:
+            # /favicon.ico no reinicia la flota como '/'
+            if requests.get(f"{url}/favicon.ico", timeout=1).status_code == 204:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+def medir_modo(modo, args):
+    url = f"http://127.0.0.1:{args.puerto}"
+    servidor = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--servidor", "--modo", modo,
+         "--puerto", str(args.puerto), "--ambulancias", str(args.ambulancias)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    try:
+        if not esperar_servidor(url):
+            return {"modo": modo, "error": "el servidor no respondió"}
+
+        control = socketio.Client(reconnection=False)
+        control.connect(url, transports=["polling"])
+        monitor = MonitorProceso(servidor.pid)
+
+        # Tiempo para que todos los clientes terminen de conectarse
+        inicio = time.time() + max(5, args.clientes / 50)
+        fin = inicio + args.duracion
+        reparto = [args.clientes // args.procesos + (1 if i < args.clientes % args.procesos else 0)
+                   for i in range(args.procesos)]
+        with multiprocessing.Pool(args.procesos) as pool:
+            pendiente = pool.starmap_async(
+                ejecutar_clientes,
+                [(url, n, inicio, fin, args.transporte) for n in reparto if n > 0]
+            )
+            time.sleep(max(0, inicio - time.time()))
+            enviados_inicio = control.call("carga_estadisticas", timeout=10) or {}
+            monitor.iniciar()
+            time.sleep(max(0, fin - time.time()))
+            enviados_fin = control.call("carga_estadisticas", timeout=10) or {}
+            monitor.detener()
+            parciales = pendiente.get(timeout=args.duracion + 120)
+        control.disconnect()
+    finally:
+        servidor.terminate()
+        try:
+            servidor.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            servidor.kill()
+
+    conectados = sum(p["conectados"] for p in parciales)
+    recibidos = Counter()
+    latencias = {}
+    esperados_seq = Counter()
+    perdidos_seq = Counter()
+    for p in parciales:
+        recibidos.update(p["recibidos"])
+        for evento, valores in p["latencias"].items():
+            latencias.setdefault(evento, []).extend(valores)
+        esperados_seq.update(p["esperados_seq"])
+        perdidos_seq.update(p["perdidos_seq"])
+
+    # Pérdida por evento: enviados (broadcast) x clientes conectados vs recibidos
+    perdida_eventos = {}
+    for evento in EVENTOS:
+        enviados = enviados_fin.get(evento, 0) - enviados_inicio.get(evento, 0)
+        if enviados > 0 and conectados > 0:
+            perdida_eventos[evento] = round(max(0.0, 1 - recibidos[evento] / (enviados * conectados)) * 100, 2)
+
+    def ms(valor):
+        return round(valor * 1000, 2) if valor is not None else None
+
+    return {
+        "modo": modo,
+        "clientes": args.clientes,
+        "conectados": conectados,
+        "fallidos": sum(p["fallidos"] for p in parciales),
+        "mensajes_por_segundo": round(sum(recibidos.values()) / args.duracion, 1),
+        "mensajes_por_segundo_evento": {evento: round(n / args.duracion, 1) for evento, n in recibidos.items()},
+        # Las latencias y la pérdida por numeración se reportan por evento: los
+        # frames de posiciones son muchos más y taparían a los demás en un solo percentil
+        "latencia_ms": {evento: {
+            "p50": ms(percentil(valores, 50)),
+            "p95": ms(percentil(valores, 95)),
+            "p99": ms(percentil(valores, 99)),
+            "max": ms(max(valores))
+        } for evento, valores in latencias.items() if valores},
+        "perdida_seq_pct": {evento: round(perdidos_seq[evento] / esperados * 100, 2)
+                            for evento, esperados in esperados_seq.items() if esperados},
+        "perdida_eventos_pct": perdida_eventos,
+        "cpu_pct": {
+            "media": round(sum(monitor.cpu) / len(monitor.cpu), 1) if monitor.cpu else None,
+            "max": round(max(monitor.cpu), 1) if monitor.cpu else None
+        },
+        "rss_mb_max": round(max(monitor.rss), 1) if monitor.rss else None
+    }
+
+def imprimir_tabla(resultados):
+    columnas = ["modo", "evento", "conectados", "msg/s", "p50 ms", "p95 ms", "p99 ms", "pérdida %",
+                "CPU % media", "RSS MB"]
+    filas = []
+    for r in resultados:
+        if "error" in r:
+            filas.append([r["modo"], "-", "-", "-", "-", "-", "-", "-", "-", r["error"]])
+            continue
+        # Una fila por evento; las columnas del servidor se repiten en cada una
+        for evento in EVENTOS:
+            latencia = r["latencia_ms"].get(evento, {})
+            filas.append([
+                r["modo"], evento, f"{r['conectados']}/{r['clientes']}",
+                r["mensajes_por_segundo_evento"].get(evento, 0),
+                latencia.get("p50"), latencia.get("p95"), latencia.get("p99"),
+                r["perdida_seq_pct"].get(evento), r["cpu_pct"]["media"], r["rss_mb_max"]
+            ])
+    anchos = [max(len(str(c)), *(len(str(f[i])) for f in filas)) for i, c in enumerate(columnas)]
+    print("  ".join(str(c).ljust(a) for c, a in zip(columnas, anchos)))
+    for fila in filas:
+        print("  ".join(str(v).ljust(a) for v, a in zip(fila, anchos)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del fan-out de Socket.IO del simulador")
+    parser.add_argument("--clientes", type=int, default=200)
+    parser.add_argument("--duracion", type=float, default=20, help="segundos de medición")
+    parser.add_argument("--ambulancias", type=int, default=3)
+    parser.add_argument("--modos", default=",".join(MODOS_ASYNC))
+    parser.add_argument("--procesos", type=int, default=max(1, min(8, os.cpu_count() or 1)),
+                        help="procesos que reparten los clientes")
+    parser.add_argument("--transporte", choices=["websocket", "polling"], default="websocket")
+    parser.add_argument("--puerto", type=int, default=5055)
+    parser.add_argument("--salida", help="archivo JSON con los resultados completos")
+    parser.add_argument("--servidor-rutas", action="store_true",
+                        help="solo levanta el servidor de rutas simulado en --puerto")
+    parser.add_argument("--servidor", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--modo", default="threading", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.servidor_rutas:
+        ejecutar_servidor_rutas(args.puerto)
+        return
+    if args.servidor:
+        ejecutar_servidor(args.modo, args.puerto, args.ambulancias)
+        return
+
+    solicitados = [m.strip() for m in args.modos.split(",") if m.strip()]
+    modos = modos_disponibles(solicitados)
+    for modo in solicitados:
+        if modo not in modos:
+            print(f"[CARGA] Modo {modo} no disponible (falta el paquete), se omite")
+
+    resultados = []
+    for modo in modos:
+        print(f"[CARGA] Midiendo {modo} con {args.clientes} clientes durante {args.duracion}s...")
+        resultados.append(medir_modo(modo, args))
+
+    imprimir_tabla(resultados)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            json.dump(resultados, archivo, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,10 @@
 import math
+import time
+import heapq
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
 
 def calcular_distancia_km(nodo1, nodo2):
     """Calcula la distancia entre dos nodos en kilómetros usando la fórmula de Haversine"""
@@ -11,17 +17,23 @@ def calcular_distancia_km(nodo1, nodo2):
     return R * c
 
 class Nodo:
+    __slots__ = ('lat', 'lon', 'id')
+
     def __init__(self, lat, lon, id=None):
         self.lat = lat
         self.lon = lon
         self.id = id
 
 class Ruta:
+    __slots__ = ('nodos', 'tiempo_total')
+
     def __init__(self, nodos, tiempo_total):
         self.nodos = nodos
         self.tiempo_total = tiempo_total
 
 class Via:
+    __slots__ = ('origen', 'destino', 'distancia_km', 'trafico', 'bloqueada')
+
     def __init__(self, origen, destino, distancia_km, trafico=0, bloqueada=False):
         self.origen = origen
         self.destino = destino
@@ -36,8 +48,216 @@ class Via:
         multiplicador_trafico = 1 + (self.trafico * 1)  # hasta 1x más tiempo
         return tiempo_base * multiplicador_trafico
 
+# Geometrías de rutas compartidas
+class Geometria:
+    """Vista de solo lectura (sin copia) sobre una geometría del almacén"""
+    __slots__ = ('id', '_datos')
+
+    def __init__(self, id, datos):
+        self.id = id
+        self._datos = datos  # memoryview de float64: lat0, lon0, lat1, lon1, ...
+
+    def __len__(self):
+        return len(self._datos) // 2
+
+    def __getitem__(self, indice):
+        if isinstance(indice, slice):
+            inicio, fin, paso = indice.indices(len(self))
+            if paso != 1:
+                raise ValueError("Geometria solo admite cortes contiguos")
+            fin = max(inicio, fin)
+            # Un corte parcial ya no corresponde al id internado de la geometría completa
+            id = self.id if (inicio, fin) == (0, len(self)) else None
+            return Geometria(id, self._datos[inicio * 2:fin * 2])
+        if indice < 0:
+            indice += len(self)
+        if indice < 0 or indice >= len(self):
+            raise IndexError("índice fuera de la geometría")
+        return (self._datos[indice * 2], self._datos[indice * 2 + 1])
+
+    def __iter__(self):
+        datos = self._datos
+        for i in range(0, len(datos), 2):
+            yield (datos[i], datos[i + 1])
+
+    def to_lista(self):
+        """Convierte la geometría a [[lat, lon], ...] para serializar a JSON"""
+        datos = self._datos.tolist()
+        return [[datos[i], datos[i + 1]] for i in range(0, len(datos), 2)]
+
+
+class AlmacenGeometrias:
+    """
+    Almacén de geometrías internadas: cada ruta se guarda una sola vez como
+    un buffer contiguo de float64 con un id estable derivado de su contenido
+    """
+    def __init__(self, max_geometrias=1000):
+        self.max_geometrias = max_geometrias
+        self._geometrias = OrderedDict()  # {id: array('d')}
+        self._lock = threading.Lock()
+
+    def guardar(self, nodos):
+        """Interna una lista de [lat, lon] (o una Geometria) y devuelve su vista"""
+        if isinstance(nodos, Geometria) and nodos.id is not None:
+            return nodos
+        datos = array('d')
+        for lat, lon in nodos:
+            datos.append(lat)
+            datos.append(lon)
+        id = hashlib.blake2b(datos.tobytes(), digest_size=8).hexdigest()
+        with self._lock:
+            existente = self._geometrias.get(id)
+            if existente is not None:
+                self._geometrias.move_to_end(id)
+                datos = existente
+            else:
+                if len(self._geometrias) >= self.max_geometrias:
+                    # Las vistas ya entregadas mantienen vivo su buffer
+                    self._geometrias.popitem(last=False)
+                self._geometrias[id] = datos
+        return Geometria(id, memoryview(datos).toreadonly())
+
+    def obtener(self, id):
+        """Obtiene la vista de una geometría por su id"""
+        with self._lock:
+            datos = self._geometrias.get(id)
+        if datos is None:
+            return None
+        return Geometria(id, memoryview(datos).toreadonly())
+
+    def __contains__(self, id):
+        return id in self._geometrias
+
+    def __len__(self):
+        return len(self._geometrias)
+
+# Caché de sub-rutas por teselas geohash
+_BASE32_GEOHASH = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash(lat, lon, precision=7):
+    """Codifica una coordenada como geohash de la precisión indicada"""
+    rango_lat, rango_lon = [-90.0, 90.0], [-180.0, 180.0]
+    resultado = []
+    bits, valor, es_lon = 0, 0, True
+    while len(resultado) < precision:
+        rango, coordenada = (rango_lon, lon) if es_lon else (rango_lat, lat)
+        medio = (rango[0] + rango[1]) / 2
+        valor <<= 1
+        if coordenada >= medio:
+            valor |= 1
+            rango[0] = medio
+        else:
+            rango[1] = medio
+        es_lon = not es_lon
+        bits += 1
+        if bits == 5:
+            resultado.append(_BASE32_GEOHASH[valor])
+            bits, valor = 0, 0
+    return "".join(resultado)
+
+def geohash_vecindad(lat, lon, precision=7):
+    """Geohash de la tesela del punto y de sus 8 vecinas"""
+    bits = precision * 5
+    alto = 180.0 / (1 << (bits // 2))
+    ancho = 360.0 / (1 << ((bits + 1) // 2))
+    return {geohash(lat + df * alto, lon + dc * ancho, precision) for df in (-1, 0, 1) for dc in (-1, 0, 1)}
+
+
+class CacheSubrutas:
+    """
+    Caché de rutas reutilizables por sub-trayecto. Cada polilínea se indexa por
+    las teselas geohash que atraviesa; una consulta se responde cortando el
+    tramo de una ruta guardada que pasa cerca del origen y después cerca del
+    destino (los sub-caminos de un camino más corto también son óptimos)
+    """
+    def __init__(self, precision=7, tolerancia_km=0.1, max_rutas=300, ttl=300):
+        self.precision = precision  # 7 -> teselas de ~150 m
+        self.tolerancia_km = tolerancia_km  # debe ser menor que el lado de la tesela
+        self.max_rutas = max_rutas
+        self.ttl = ttl
+        self._rutas = OrderedDict()  # {id: (geometria, acumulado_km, tiempo_min, timestamp, teselas)}
+        self._teselas = {}  # {geohash: {id: [indices de nodos]}}
+        self._siguiente_id = 0
+        self._lock = threading.Lock()
+
+    def guardar(self, geometria, distancia_km, tiempo_min):
+        """Indexa una ruta (Geometria) completa obtenida de un proveedor"""
+        if len(geometria) < 3 or not tiempo_min or tiempo_min <= 0:
+            return
+        acumulado = array('d', [0.0])
+        teselas = {}
+        previo = None
+        for i, (lat, lon) in enumerate(geometria):
+            if previo is not None:
+                acumulado.append(acumulado[-1] + calcular_distancia_km(previo, Nodo(lat, lon)))
+            previo = Nodo(lat, lon)
+            teselas.setdefault(geohash(lat, lon, self.precision), []).append(i)
+        with self._lock:
+            if len(self._rutas) >= self.max_rutas:
+                self._eliminar(next(iter(self._rutas)))
+            id = self._siguiente_id
+            self._siguiente_id += 1
+            self._rutas[id] = (geometria, acumulado, tiempo_min, time.time(), list(teselas))
+            for tesela, indices in teselas.items():
+                self._teselas.setdefault(tesela, {})[id] = indices
+
+    def _eliminar(self, id):
+        _, _, _, _, teselas = self._rutas.pop(id)
+        for tesela in teselas:
+            rutas = self._teselas.get(tesela)
+            if rutas is not None:
+                rutas.pop(id, None)
+                if not rutas:
+                    del self._teselas[tesela]
+
+    def _cercanos(self, punto):
+        """Para cada ruta, el índice de su nodo más cercano al punto dentro de la tolerancia"""
+        mejores = {}  # {id: (distancia_km, indice)}
+        for tesela in geohash_vecindad(punto.lat, punto.lon, self.precision):
+            for id, indices in self._teselas.get(tesela, {}).items():
+                geometria = self._rutas[id][0]
+                for i in indices:
+                    lat, lon = geometria[i]
+                    distancia = calcular_distancia_km(punto, Nodo(lat, lon))
+                    if distancia <= self.tolerancia_km and (id not in mejores or distancia < mejores[id][0]):
+                        mejores[id] = (distancia, i)
+        return mejores
+
+    def buscar(self, origen, destino):
+        """
+        Busca una ruta guardada que cubra el par dentro de la tolerancia
+        Retorna: (sub_geometria, distancia_km, tiempo_min) o None
+        """
+        with self._lock:
+            ahora = time.time()
+            for id in [id for id, ruta in self._rutas.items() if ahora - ruta[3] >= self.ttl]:
+                self._eliminar(id)
+            desde = self._cercanos(origen)
+            if not desde:
+                return None
+            hasta = self._cercanos(destino)
+            mejor = None
+            for id in desde.keys() & hasta.keys():
+                (d_origen, i), (d_destino, j) = desde[id], hasta[id]
+                if j - i < 2:
+                    continue  # el tramo debe ir en el sentido de la ruta y tener más de 2 nodos
+                if mejor is None or d_origen + d_destino < mejor[0]:
+                    mejor = (d_origen + d_destino, id, i, j)
+            if mejor is None:
+                return None
+            _, id, i, j = mejor
+            self._rutas.move_to_end(id)
+            geometria, acumulado, tiempo_total, _, _ = self._rutas[id]
+        distancia_km = acumulado[j] - acumulado[i]
+        tiempo_min = tiempo_total * distancia_km / acumulado[-1] if acumulado[-1] > 0 else tiempo_total
+        return geometria[i:j + 1], distancia_km, tiempo_min
+
+    def __len__(self):
+        return len(self._rutas)
+
 # Especialidades ecvaluadas   
 class Hospital:
+    # Las instancias publicadas en un EstadoVersionado no se modifican: usar copiar()
     def __init__(self, nombre, lat, lon, tiempo_espera=0, especialidades=None, capacidad_max=10, pacientes_actuales=0):
         self.nombre = nombre
         self.lat = lat
@@ -53,10 +273,75 @@ class Hospital:
     def porcentaje_ocupacion(self):
         return self.pacientes_actuales / self.capacidad_max if self.capacidad_max > 0 else 0
 
+    def copiar(self, **cambios):
+        """Devuelve una copia del hospital con los campos indicados modificados"""
+        datos = {
+            "tiempo_espera": self.tiempo_espera,
+            "especialidades": self.especialidades,
+            "capacidad_max": self.capacidad_max,
+            "pacientes_actuales": self.pacientes_actuales
+        }
+        datos.update(cambios)
+        return Hospital(self.nombre, self.lat, self.lon, **datos)
+
+
+# Estado versionado con copia en escritura
+class Instantanea:
+    """Estado inmutable de hospitales y flota en una versión dada"""
+    __slots__ = ('version', 'hospitales', 'ambulancias', '_serializados')
+
+    def __init__(self, version, hospitales, ambulancias, serializados=None):
+        self.version = version
+        self.hospitales = tuple(hospitales)
+        self.ambulancias = tuple(ambulancias)
+        self._serializados = serializados or {}  # {componente: payload}
+
+    def serializar(self, componente, funcion):
+        """Calcula funcion(instantanea) una sola vez por versión del componente"""
+        resultado = self._serializados.get(componente)
+        if resultado is None:
+            resultado = funcion(self)
+            self._serializados[componente] = resultado
+        return resultado
+
+
+class EstadoVersionado:
+    """
+    Publica instantáneas inmutables de forma atómica: los lectores solo leen
+    la referencia actual (sin bloqueo) y los escritores crean una versión nueva
+    """
+    def __init__(self, hospitales=(), ambulancias=()):
+        self._lock = threading.Lock()
+        self._actual = Instantanea(0, hospitales, ambulancias)
+
+    def actual(self):
+        """Obtiene la instantánea vigente"""
+        return self._actual
+
+    def publicar(self, hospitales=None, ambulancias=None):
+        """Publica una nueva versión; lo que no se indique se conserva de la anterior"""
+        with self._lock:
+            previa = self._actual
+            # Los payloads de los componentes que no cambian se heredan
+            serializados = {}
+            if hospitales is None:
+                hospitales = previa.hospitales
+                if "hospitales" in previa._serializados:
+                    serializados["hospitales"] = previa._serializados["hospitales"]
+            if ambulancias is None:
+                ambulancias = previa.ambulancias
+                if "ambulancias" in previa._serializados:
+                    serializados["ambulancias"] = previa._serializados["ambulancias"]
+            nueva = Instantanea(previa.version + 1, hospitales, ambulancias, serializados)
+            self._actual = nueva
+        return nueva
+
 
 # Listas enlazadas, árboles binarios de búsqueda y grafos
 class NodoLista:
     """Nodo de una lista enlazada"""
+    __slots__ = ('dato', 'siguiente')
+
     def __init__(self, dato):
         self.dato = dato
         self.siguiente = None
@@ -198,28 +483,241 @@ class NodoGrafo:
         """Agrega una arista hacia otro nodo"""
         self.adyacentes[destino_id] = peso
 
+class IndiceEspacial:
+    """
+    Índice espacial de rejilla uniforme sobre los nodos y aristas de un grafo.
+    Las consultas recorren anillos de celdas alrededor del punto hasta que
+    ningún elemento no visitado puede estar más cerca que los encontrados
+    """
+    KM_POR_GRADO = 111.32
+
+    def __init__(self, tamanio_celda=0.002):
+        self.tamanio_celda = tamanio_celda  # grados (~220 m)
+        self._nodos = {}    # {(fila, columna): [nodo, ...]}
+        self._aristas = {}  # {(fila, columna): [(nodo_origen, nodo_destino), ...]}
+        self._limites = None  # (fila_min, fila_max, col_min, col_max)
+        self.num_nodos = 0
+
+    def _celda(self, lat, lon):
+        return (math.floor(lat / self.tamanio_celda), math.floor(lon / self.tamanio_celda))
+
+    def _ampliar_limites(self, fila, columna):
+        if self._limites is None:
+            self._limites = (fila, fila, columna, columna)
+        else:
+            f0, f1, c0, c1 = self._limites
+            self._limites = (min(f0, fila), max(f1, fila), min(c0, columna), max(c1, columna))
+
+    def insertar(self, nodo):
+        """Agrega un nodo al índice"""
+        celda = self._celda(nodo.lat, nodo.lon)
+        self._nodos.setdefault(celda, []).append(nodo)
+        self._ampliar_limites(*celda)
+        self.num_nodos += 1
+
+    def cargar(self, nodos):
+        """Carga masiva: agrupa los nodos por celda antes de insertarlos"""
+        grupos = {}
+        for nodo in nodos:
+            grupos.setdefault(self._celda(nodo.lat, nodo.lon), []).append(nodo)
+        for celda, grupo in grupos.items():
+            self._nodos.setdefault(celda, []).extend(grupo)
+            self._ampliar_limites(*celda)
+            self.num_nodos += len(grupo)
+
+    def insertar_arista(self, origen, destino):
+        """Registra una arista en todas las celdas de su rectángulo envolvente"""
+        f1, c1 = self._celda(origen.lat, origen.lon)
+        f2, c2 = self._celda(destino.lat, destino.lon)
+        for fila in range(min(f1, f2), max(f1, f2) + 1):
+            for columna in range(min(c1, c2), max(c1, c2) + 1):
+                self._aristas.setdefault((fila, columna), []).append((origen, destino))
+                self._ampliar_limites(fila, columna)
+
+    def _anillo(self, centro, radio):
+        """Celdas a distancia de Chebyshev exactamente 'radio' del centro"""
+        f0, c0 = centro
+        if radio == 0:
+            yield centro
+            return
+        for columna in range(c0 - radio, c0 + radio + 1):
+            yield (f0 - radio, columna)
+            yield (f0 + radio, columna)
+        for fila in range(f0 - radio + 1, f0 + radio):
+            yield (fila, c0 - radio)
+            yield (fila, c0 + radio)
+
+    def _radio_maximo(self, centro):
+        """Último anillo que todavía puede contener celdas ocupadas"""
+        if self._limites is None:
+            return -1
+        f0, f1, c0, c1 = self._limites
+        return max(abs(centro[0] - f0), abs(centro[0] - f1), abs(centro[1] - c0), abs(centro[1] - c1))
+
+    def _km_por_anillo(self, lat):
+        """Distancia mínima garantizada por cada anillo recorrido"""
+        return self.tamanio_celda * self.KM_POR_GRADO * max(math.cos(math.radians(abs(lat) + self.tamanio_celda)), 0.01)
+
+    def _celdas_ocupadas(self, celdas, centro, radio):
+        """
+        Recorrer el anillo 'radio' cuesta más que revisar todas las celdas ocupadas
+        (punto lejos de los datos): se revisan directamente las ocupadas restantes
+        """
+        if (2 * radio + 1) ** 2 <= len(celdas):
+            return None
+        return [c for c in celdas if max(abs(c[0] - centro[0]), abs(c[1] - centro[1])) >= radio]
+
+    def mas_cercanos(self, lat, lon, k=1, radio_max_km=None):
+        """Retorna los k nodos más cercanos como lista de (distancia_km, nodo)"""
+        if k <= 0:
+            return []
+        centro = self._celda(lat, lon)
+        radio_max = self._radio_maximo(centro)
+        km_anillo = self._km_por_anillo(lat)
+        if radio_max_km is not None:
+            radio_max = min(radio_max, int(math.ceil(radio_max_km / km_anillo)) + 1)
+        punto = Nodo(lat, lon)
+        encontrados = []
+        radio = 0
+        while radio <= radio_max:
+            restantes = self._celdas_ocupadas(self._nodos, centro, radio)
+            if restantes is not None:
+                for celda in restantes:
+                    for nodo in self._nodos[celda]:
+                        encontrados.append((calcular_distancia_km(punto, nodo), nodo))
+                break
+            for celda in self._anillo(centro, radio):
+                for nodo in self._nodos.get(celda, ()):
+                    encontrados.append((calcular_distancia_km(punto, nodo), nodo))
+            if len(encontrados) >= k:
+                encontrados.sort(key=lambda par: par[0])
+                del encontrados[k:]
+                # Todo nodo fuera de los anillos vistos está al menos a radio * km_anillo
+                if encontrados[-1][0] <= radio * km_anillo:
+                    break
+            radio += 1
+        if radio_max_km is not None:
+            encontrados = [par for par in encontrados if par[0] <= radio_max_km]
+        encontrados.sort(key=lambda par: par[0])
+        return encontrados[:k]
+
+    def en_radio(self, lat, lon, radio_km):
+        """Retorna los nodos a menos de radio_km como lista de (distancia_km, nodo)"""
+        centro = self._celda(lat, lon)
+        anillos = min(int(math.ceil(radio_km / self._km_por_anillo(lat))) + 1, self._radio_maximo(centro))
+        punto = Nodo(lat, lon)
+        resultado = []
+        if (2 * anillos + 1) ** 2 > len(self._nodos):
+            # Menos celdas ocupadas que celdas en el radio: se revisan las ocupadas
+            celdas = [c for c in self._nodos if max(abs(c[0] - centro[0]), abs(c[1] - centro[1])) <= anillos]
+        else:
+            celdas = [c for radio in range(anillos + 1) for c in self._anillo(centro, radio)]
+        for celda in celdas:
+            for nodo in self._nodos.get(celda, ()):
+                distancia = calcular_distancia_km(punto, nodo)
+                if distancia <= radio_km:
+                    resultado.append((distancia, nodo))
+        resultado.sort(key=lambda par: par[0])
+        return resultado
+
+    def arista_mas_cercana(self, lat, lon):
+        """
+        Proyecta el punto sobre la arista más cercana
+        Retorna: (distancia_km, nodo_origen, nodo_destino, fraccion, (lat, lon)) o None
+        """
+        centro = self._celda(lat, lon)
+        radio_max = self._radio_maximo(centro)
+        km_anillo = self._km_por_anillo(lat)
+        punto = Nodo(lat, lon)
+        escala = math.cos(math.radians(lat))
+        mejor = None
+        vistas = set()
+        radio = 0
+        while radio <= radio_max:
+            restantes = self._celdas_ocupadas(self._aristas, centro, radio)
+            celdas = restantes if restantes is not None else self._anillo(centro, radio)
+            for celda in celdas:
+                for origen, destino in self._aristas.get(celda, ()):
+                    clave = (id(origen), id(destino))
+                    if clave in vistas:
+                        continue
+                    vistas.add(clave)
+                    # Proyección local equirectangular del punto sobre el segmento
+                    ax, ay = (origen.lon - lon) * escala, origen.lat - lat
+                    dx, dy = (destino.lon - origen.lon) * escala, destino.lat - origen.lat
+                    largo2 = dx * dx + dy * dy
+                    fraccion = 0.0 if largo2 == 0 else min(1.0, max(0.0, -(ax * dx + ay * dy) / largo2))
+                    proyectado = Nodo(origen.lat + fraccion * (destino.lat - origen.lat),
+                                      origen.lon + fraccion * (destino.lon - origen.lon))
+                    distancia = calcular_distancia_km(punto, proyectado)
+                    if mejor is None or distancia < mejor[0]:
+                        mejor = (distancia, origen, destino, fraccion, (proyectado.lat, proyectado.lon))
+            if restantes is not None or (mejor is not None and mejor[0] <= radio * km_anillo):
+                break
+            radio += 1
+        return mejor
+
+    def __len__(self):
+        return self.num_nodos
+
 class Grafo:
     """Grafo dirigido con pesos para representar la red de calles"""
     def __init__(self):
         self.nodos = {}
         self.num_nodos = 0
+        self.indice = IndiceEspacial()
+        self.inversos = {}  # {id_destino: {id_origen: peso}} para búsquedas hacia atrás
     
     def agregar_nodo(self, id, lat, lon):
         """Agrega un nodo al grafo"""
         if id not in self.nodos:
             self.nodos[id] = NodoGrafo(id, lat, lon)
             self.num_nodos += 1
+            self.indice.insertar(self.nodos[id])
         return self.nodos[id]
     
+    def cargar_nodos(self, nodos):
+        """Carga masiva de nodos [(id, lat, lon), ...] con un solo paso sobre el índice"""
+        nuevos = []
+        for id, lat, lon in nodos:
+            if id not in self.nodos:
+                self.nodos[id] = NodoGrafo(id, lat, lon)
+                nuevos.append(self.nodos[id])
+        self.num_nodos += len(nuevos)
+        self.indice.cargar(nuevos)
+    
     def agregar_arista(self, origen_id, destino_id, peso):
         """Agrega una arista dirigida con peso"""
         if origen_id in self.nodos and destino_id in self.nodos:
-            self.nodos[origen_id].agregar_arista(destino_id, peso)
+            origen = self.nodos[origen_id]
+            if destino_id not in origen.adyacentes:
+                self.indice.insertar_arista(origen, self.nodos[destino_id])
+            origen.agregar_arista(destino_id, peso)
+            self.inversos.setdefault(destino_id, {})[origen_id] = peso
     
     def obtener_nodo(self, id):
         """Obtiene un nodo por su ID"""
         return self.nodos.get(id)
     
+    def nodos_cercanos(self, lat, lon, k=1, radio_max_km=None):
+        """Obtiene los k nodos más cercanos a una coordenada: [(distancia_km, nodo), ...]"""
+        return self.indice.mas_cercanos(lat, lon, k, radio_max_km)
+    
+    def nodos_en_radio(self, lat, lon, radio_km):
+        """Obtiene los nodos a menos de radio_km de una coordenada"""
+        return self.indice.en_radio(lat, lon, radio_km)
+    
+    def ajustar_a_arista(self, lat, lon):
+        """
+        Ajusta una coordenada a la arista más cercana
+        Retorna: (origen_id, destino_id, fraccion, distancia_km) o None si el grafo no tiene aristas
+        """
+        resultado = self.indice.arista_mas_cercana(lat, lon)
+        if resultado is None:
+            return None
+        distancia, origen, destino, fraccion, _ = resultado
+        return origen.id, destino.id, fraccion, distancia
+    
     def dijkstra(self, origen_id, destino_id):
         """
         Implementa el algoritmo de Dijkstra para encontrar el camino más corto
@@ -279,6 +777,64 @@ class Grafo:
         
         return None, None, None
     
+    def busqueda_inversa_multiorigen(self, destinos, origenes, k=1):
+        """
+        Dijkstra inverso desde el destino sobre las aristas entrantes: en una sola
+        pasada encuentra los k orígenes con menor costo hasta el destino
+        destinos: {nodo_id: costo_inicial} (p. ej. los extremos de la arista donde está el destino)
+        origenes: {etiqueta: (nodo_id, costo_acceso)}
+        Retorna: [(costo_total, etiqueta, camino_lista_nodos), ...] ordenada por costo
+        """
+        destinos = {nodo_id: costo for nodo_id, costo in destinos.items() if nodo_id in self.nodos}
+        if not destinos or not origenes or k <= 0:
+            return []
+        
+        por_nodo = {}
+        for etiqueta, (nodo_id, acceso) in origenes.items():
+            if nodo_id in self.nodos:
+                por_nodo.setdefault(nodo_id, []).append((etiqueta, acceso))
+        
+        distancias = dict(destinos)
+        siguiente = {}  # {nodo_id: nodo siguiente en el camino hacia el destino}
+        visitados = set()
+        pendientes = len(por_nodo)
+        cola = [(costo, nodo_id) for nodo_id, costo in destinos.items()]
+        heapq.heapify(cola)
+        encontrados = []  # [(costo_total, etiqueta, nodo_id)] ordenada
+        
+        while cola and pendientes > 0:
+            distancia, nodo_id = heapq.heappop(cola)
+            if nodo_id in visitados:
+                continue
+            # Ningún origen sin visitar puede mejorar los k ya encontrados
+            if len(encontrados) >= k and distancia >= encontrados[k - 1][0]:
+                break
+            visitados.add(nodo_id)
+            
+            if nodo_id in por_nodo:
+                pendientes -= 1
+                for etiqueta, acceso in por_nodo[nodo_id]:
+                    encontrados.append((distancia + acceso, etiqueta, nodo_id))
+                encontrados.sort(key=lambda r: r[0])
+            
+            for previo_id, peso in self.inversos.get(nodo_id, {}).items():
+                nueva_distancia = distancia + peso
+                if previo_id not in visitados and nueva_distancia < distancias.get(previo_id, float('inf')):
+                    distancias[previo_id] = nueva_distancia
+                    siguiente[previo_id] = nodo_id
+                    heapq.heappush(cola, (nueva_distancia, previo_id))
+        
+        resultado = []
+        for costo, etiqueta, nodo_id in encontrados[:k]:
+            camino = []
+            nodo = nodo_id
+            while nodo is not None:
+                nodo_obj = self.nodos[nodo]
+                camino.append([nodo_obj.lat, nodo_obj.lon])
+                nodo = siguiente.get(nodo)
+            resultado.append((costo, etiqueta, camino))
+        return resultado
+    
     def construir_grafo_desde_ruta(self, ruta_nodos, distancia_total, origen_id, destino_id, origen_lat, origen_lon, destino_lat, destino_lon):
         """
         Construye un grafo desde una ruta obtenida de una API externa
@@ -290,6 +846,8 @@ class Grafo:
         # Limpiar nodos previos para este grafo
         self.nodos = {}
         self.num_nodos = 0
+        self.indice = IndiceEspacial()
+        self.inversos = {}
         
         # Agregar nodo origen
         self.agregar_nodo(origen_id, origen_lat, origen_lon)
@@ -367,3 +925,67 @@ class Ambulancia:
         self.pos = Nodo(lat, lon)
         self.especialidad = especialidad
         self.historial = ListaEnlazada()  # Ahora usa ListaEnlazada
+        self.ocupada_hasta = 0  # timestamp hasta el que está reservada para un incidente
+    
+    def disponible(self):
+        return time.time() >= self.ocupada_hasta
+    
+    def reservar(self, segundos):
+        """Marca la ambulancia como ocupada durante los segundos indicados"""
+        self.ocupada_hasta = time.time() + segundos
+    
+    def liberar(self):
+        self.ocupada_hasta = 0
+
+class PlanRuta:
+    """Ruta en curso de una ambulancia con un cursor sobre sus nodos"""
+    def __init__(self, hospital, ruta, costo, penalizacion=0):
+        self.hospital = hospital
+        self.ruta = ruta
+        self.costo = costo
+        self.penalizacion = penalizacion  # parte del costo que depende del hospital
+        self.costo_viaje = max(costo - penalizacion, 0)
+        self.paso = max(1, len(ruta.nodos) // 15)
+        self.cursor = 0  # índice del siguiente nodo a visitar
+        # Distancia acumulada hasta cada nodo para estimar la fracción restante
+        self._acumulado = array('d', [0.0])
+        nodos = ruta.nodos
+        for i in range(1, len(nodos)):
+            self._acumulado.append(self._acumulado[-1] + calcular_distancia_km(
+                Nodo(nodos[i - 1][0], nodos[i - 1][1]), Nodo(nodos[i][0], nodos[i][1])
+            ))
+    
+    def terminado(self):
+        return self.cursor >= len(self.ruta.nodos)
+    
+    def avanzar(self):
+        """Devuelve el siguiente nodo a visitar y mueve el cursor un paso"""
+        nodo = self.ruta.nodos[self.cursor]
+        self.cursor += self.paso
+        return nodo
+    
+    def nodo_siguiente(self):
+        """Nodo desde el que se replanifica (el próximo que se visitará)"""
+        if self.terminado():
+            return None
+        return self.ruta.nodos[self.cursor]
+    
+    def fraccion_restante(self):
+        """Fracción de la distancia total que falta por recorrer"""
+        total = self._acumulado[-1]
+        if total <= 0 or self.terminado():
+            return 0.0
+        return (total - self._acumulado[self.cursor]) / total
+    
+    def progreso(self):
+        """Fracción de la distancia total ya recorrida (hasta el último nodo visitado)"""
+        total = self._acumulado[-1]
+        if total <= 0 or self.cursor == 0:
+            return 0.0
+        return self._acumulado[min(self.cursor - self.paso, len(self.ruta.nodos) - 1)] / total
+    
+    def costo_restante(self, penalizacion=None):
+        """Costo estimado del resto del plan con la penalización indicada (o la original)"""
+        if penalizacion is None:
+            penalizacion = self.penalizacion
+        return self.costo_viaje * self.fraccion_restante() + penalizacion
@@ -45,24 +45,31 @@ ambulancias.forEach(a => {
         .bindPopup(`Ambulancia ${a.id}<br>Especialidad: ${a.especialidad || 'N/A'}`);
 });
 
-// Crear marcadores de hospitales
-hospitales.forEach(h => {
+// Guardar marcadores de hospitales
+const markersHos = {};
+
+function popupHospital(h) {
     const ocupacion = h.porcentaje_ocupacion || 0;
     const puedeRecibir = h.puede_recibir !== undefined ? h.puede_recibir : true;
     const estadoColor = puedeRecibir ? (ocupacion < 70 ? 'green' : 'orange') : 'red';
     
-    L.marker([h.lat, h.lon], { 
-        icon: iconHos,
-        zIndexOffset: 500
-    })
-    .addTo(map)
-    .bindPopup(`
+    return `
         <strong>${h.nombre}</strong><br>
         Espera: ${h.espera} min<br>
         Capacidad: ${h.pacientes_actuales || 0}/${h.capacidad_max || 'N/A'}<br>
         Ocupación: ${ocupacion}%<br>
         Estado: <span style="color: ${estadoColor}">${puedeRecibir ? 'Disponible' : 'Lleno'}</span>
-    `);
+    `;
+}
+
+// Crear marcadores de hospitales
+hospitales.forEach(h => {
+    markersHos[h.nombre] = L.marker([h.lat, h.lon], { 
+        icon: iconHos,
+        zIndexOffset: 500
+    })
+    .addTo(map)
+    .bindPopup(popupHospital(h));
 });
 
 // Capa para las rutas
@@ -72,13 +79,131 @@ const rutasLayer = L.layerGroup().addTo(map);
 
 const socket = io();
 
-// Actualiza posiciones
-socket.on("update_position", data => {
-    const m = markersAmb[data.ambulancia];
-    if (m) {
-        m.setLatLng([data.lat, data.lon]);
-        m.bindPopup(`${data.ambulancia} -> ${data.hospital}`).openPopup();
+// Geometrías conocidas por id, con la distancia acumulada hasta cada nodo
+const geometrias = new Map();
+const MAX_GEOMETRIAS = 200;
+const geometriasPedidas = new Map(); // id -> momento de la última solicitud
+const REINTENTO_GEOMETRIA_MS = 5000;
+
+function registrarGeometria(id, nodos, hospital) {
+    if (!id || !nodos || nodos.length < 2) {
+        return;
     }
+    const existente = geometrias.get(id);
+    if (existente) {
+        existente.hospital = hospital || existente.hospital;
+        return;
+    }
+    if (geometrias.size >= MAX_GEOMETRIAS) {
+        geometrias.delete(geometrias.keys().next().value);
+    }
+    const puntos = nodos.map(n => L.latLng(n[0], n[1]));
+    const acumulado = [0];
+    for (let i = 1; i < puntos.length; i++) {
+        acumulado.push(acumulado[i - 1] + puntos[i - 1].distanceTo(puntos[i]));
+    }
+    geometrias.set(id, { puntos, acumulado, hospital });
+    geometriasPedidas.delete(id);
+}
+
+// Punto a una fracción de la distancia total de la geometría
+function puntoEnGeometria(g, progreso) {
+    const total = g.acumulado[g.acumulado.length - 1];
+    const objetivo = Math.min(Math.max(progreso, 0), 1) * total;
+    let bajo = 0;
+    let alto = g.acumulado.length - 1;
+    while (bajo < alto - 1) {
+        const medio = (bajo + alto) >> 1;
+        if (g.acumulado[medio] <= objetivo) {
+            bajo = medio;
+        } else {
+            alto = medio;
+        }
+    }
+    const tramo = g.acumulado[alto] - g.acumulado[bajo];
+    const t = tramo > 0 ? (objetivo - g.acumulado[bajo]) / tramo : 0;
+    const a = g.puntos[bajo];
+    const b = g.puntos[alto];
+    return L.latLng(a.lat + (b.lat - a.lat) * t, a.lng + (b.lng - a.lng) * t);
+}
+
+socket.on("geometria", data => {
+    if (data && data.nodos) {
+        registrarGeometria(data.id, data.nodos);
+    }
+    // Si el servidor ya no la tiene, se vuelve a pedir pasado REINTENTO_GEOMETRIA_MS
+});
+
+// Movimiento en curso de cada ambulancia: interpola el progreso entre dos frames
+const movimientos = {};
+let animando = false;
+
+function progresoActual(mov, ahora) {
+    const t = mov.duracion > 0 ? Math.min((ahora - mov.inicio) / mov.duracion, 1) : 1;
+    return mov.desde + (mov.hasta - mov.desde) * t;
+}
+
+function animar() {
+    const ahora = performance.now();
+    let pendientes = false;
+    Object.entries(movimientos).forEach(([ambId, mov]) => {
+        const g = geometrias.get(mov.ruta);
+        const m = markersAmb[ambId];
+        if (!g || !m) {
+            return;
+        }
+        m.setLatLng(puntoEnGeometria(g, progresoActual(mov, ahora)));
+        if (ahora - mov.inicio < mov.duracion) {
+            pendientes = true;
+        }
+    });
+    animando = pendientes;
+    if (animando) {
+        requestAnimationFrame(animar);
+    }
+}
+
+// Un frame por tick con todas las unidades que se movieron
+socket.on("update_posiciones", frame => {
+    if (!frame || !frame.unidades) {
+        return;
+    }
+    const ahora = performance.now();
+    const duracion = (frame.intervalo || 0.5) * 1000;
+    
+    frame.unidades.forEach(u => {
+        const g = geometrias.get(u.ruta);
+        const pedida = geometriasPedidas.get(u.ruta);
+        if (!g && (pedida === undefined || ahora - pedida > REINTENTO_GEOMETRIA_MS)) {
+            geometriasPedidas.set(u.ruta, ahora);
+            socket.emit("solicitar_geometria", u.ruta);
+        }
+        
+        const previo = movimientos[u.ambulancia];
+        const desde = previo && previo.ruta === u.ruta ? progresoActual(previo, ahora) : u.progreso;
+        movimientos[u.ambulancia] = { ruta: u.ruta, desde, hasta: u.progreso, inicio: ahora, duracion };
+        
+        const m = markersAmb[u.ambulancia];
+        if (m && g && g.hospital && m.hospital !== g.hospital) {
+            m.hospital = g.hospital;
+            m.bindPopup(`${u.ambulancia} -> ${g.hospital}`);
+        }
+    });
+    
+    if (!animando) {
+        animando = true;
+        requestAnimationFrame(animar);
+    }
+});
+
+// Actualiza el estado de los hospitales (misma instantánea para todos los clientes)
+socket.on("update_hospitales", datos => {
+    (datos || []).forEach(h => {
+        const m = markersHos[h.nombre];
+        if (m) {
+            m.setPopupContent(popupHospital(h));
+        }
+    });
 });
 
 // Caché de rutas en el cliente
@@ -188,6 +313,7 @@ socket.on("update_rutas", rutas => {
         if (!r.nodos || r.nodos.length < 2) {
             return;
         }
+        registrarGeometria(r.geometria, r.nodos, r.hospital);
         
         const dibujarRuta = (nodos, tiempo) => {
             if (!nodos || nodos.length < 2) {
@@ -316,3 +442,39 @@ socket.on("update_grafo", grafoData => {
         }
     });
 });
+
+// Capa para los incidentes despachados
+const incidentesLayer = L.layerGroup().addTo(map);
+
+// Incidente atendido: unidad -> incidente -> hospital
+socket.on("incidente_asignado", data => {
+    if (!data || !data.hospital) {
+        return;
+    }
+    
+    try {
+        if (data.ruta_incidente && data.ruta_incidente.length > 1) {
+            L.polyline(data.ruta_incidente, {
+                color: 'white',
+                weight: 4,
+                opacity: 0.8,
+                dashArray: '4, 6'
+            }).addTo(incidentesLayer);
+        }
+        
+        if (data.ruta_hospital && data.ruta_hospital.length > 1) {
+            const inicio = data.ruta_hospital[0];
+            L.circleMarker(inicio, { radius: 8, color: 'red', fillOpacity: 0.9 })
+                .addTo(incidentesLayer)
+                .bindPopup(`Incidente #${data.incidente}<br>${data.ambulancia} -> ${data.hospital}<br>Tiempo total: ${data.tiempo_total} min`);
+            
+            L.polyline(data.ruta_hospital, {
+                color: 'red',
+                weight: 4,
+                opacity: 0.7
+            }).addTo(incidentesLayer);
+        }
+    } catch (error) {
+        console.error("Error dibujando incidente:", error);
+    }
+});
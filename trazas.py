@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from collections import deque, Counter
+from contextlib import contextmanager
+
+class Trazador:
+    """
+    Trazas ligeras por etapa (spans) y perfilador por muestreo bajo demanda.
+    Se activa y desactiva en caliente; desactivado solo cuesta revisar un booleano.
+    Exporta eventos de Chrome (chrome://tracing, Perfetto) y pilas colapsadas
+    para flamegraph.pl / speedscope
+    """
+    def __init__(self, max_eventos=200000, intervalo_muestreo=0.005):
+        self.activo = False
+        self.intervalo_muestreo = intervalo_muestreo
+        self._eventos = deque(maxlen=max_eventos)
+        self._pilas_spans = Counter()   # {"a;b;c": microsegundos propios}
+        self._pilas_muestras = Counter()  # {"hilo;f1;f2": muestras}
+        self._nombres_hilos = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inicio = time.perf_counter()
+        self._detener_muestreo = None  # Event del hilo de muestreo en curso
+        self._hilo_muestreo = None
+
+    # ----- CONTROL -----
+    def activar(self):
+        self.activo = True
+
+    def desactivar(self):
+        self.activo = False
+
+    def limpiar(self):
+        """Descarta los eventos y pilas acumulados"""
+        with self._lock:
+            self._eventos.clear()
+            self._pilas_spans.clear()
+            self._pilas_muestras.clear()
+
+    def estado(self):
+        return {
+            "activo": self.activo,
+            "muestreando": self._detener_muestreo is not None,
+            "eventos": len(self._eventos),
+            "muestras": sum(self._pilas_muestras.values())
+        }
+
+    # ----- SPANS -----
+    def _pila(self):
+        pila = getattr(self._local, "pila", None)
+        if pila is None:
+            pila = self._local.pila = []
+            hilo = threading.current_thread()
+            self._nombres_hilos[hilo.ident] = hilo.name
+        return pila
+
+    def _ts(self, instante):
+        return round((instante - self._inicio) * 1e6, 3)
+
+    @contextmanager
+    def span(self, nombre, **args):
+        """Mide un bloque de código: with TRAZADOR.span("etapa"): ..."""
+        if not self.activo:
+            yield
+            return
+        pila = self._pila()
+        marco = [nombre, 0.0]  # [nombre, tiempo de los spans hijos]
+        pila.append(marco)
+        ruta = ";".join(m[0] for m in pila)
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            duracion = time.perf_counter() - inicio
+            pila.pop()
+            if pila:
+                pila[-1][1] += duracion
+            self._eventos.append({
+                "name": nombre,
+                "ph": "X",
+                "ts": self._ts(inicio),
+                "dur": round(duracion * 1e6, 3),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args
+            })
+            with self._lock:
+                self._pilas_spans[ruta] += max(0, int((duracion - marco[1]) * 1e6))
+
+    def trazar(self, nombre=None):
+        """Decorador que envuelve la función en un span con su nombre"""
+        def decorador(funcion):
+            etiqueta = nombre or funcion.__name__
+
+            @functools.wraps(funcion)
+            def envoltura(*args, **kwargs):
+                if not self.activo:
+                    return funcion(*args, **kwargs)
+                with self.span(etiqueta):
+                    return funcion(*args, **kwargs)
+            return envoltura
+        return decorador
+
+    def instante(self, nombre, **args):
+        """Registra un evento puntual (p. ej. acierto o fallo de caché)"""
+        if not self.activo:
+            return
+        self._pila()
+        self._eventos.append({
+            "name": nombre,
+            "ph": "i",
+            "s": "t",
+            "ts": self._ts(time.perf_counter()),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args
+        })
+
+    # ----- PERFILADOR POR MUESTREO -----
+    def iniciar_muestreo(self):
+        """Inicia el muestreo periódico de las pilas de todos los hilos"""
+        with self._lock:
+            if self._detener_muestreo is not None:
+                return
+            # Cada hilo tiene su propio Event: un reinicio rápido no revive al anterior
+            self._detener_muestreo = threading.Event()
+            self._hilo_muestreo = threading.Thread(target=self._muestrear, args=(self._detener_muestreo,),
+                                                   name="trazas-muestreo", daemon=True)
+            self._hilo_muestreo.start()
+
+    def detener_muestreo(self):
+        with self._lock:
+            if self._detener_muestreo is not None:
+                self._detener_muestreo.set()
+            self._detener_muestreo = None
+            self._hilo_muestreo = None
+
+    def _muestrear(self, detener):
+        propio = threading.get_ident()
+        while not detener.is_set():
+            nombres = {h.ident: h.name for h in threading.enumerate()}
+            muestras = Counter()
+            for tid, frame in sys._current_frames().items():
+                if tid == propio:
+                    continue
+                marcos = []
+                while frame is not None:
+                    codigo = frame.f_code
+                    marcos.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)})")
+                    frame = frame.f_back
+                marcos.append(nombres.get(tid, str(tid)))
+                muestras[";".join(reversed(marcos))] += 1
+            if detener.is_set():
+                break
+            with self._lock:
+                self._pilas_muestras.update(muestras)
+            detener.wait(self.intervalo_muestreo)
+
+    # ----- EXPORTACIÓN -----
+    def exportar_chrome(self, ruta_archivo=None):
+        """Eventos en formato Chrome trace-event JSON"""
+        eventos = list(self._eventos)
+        for tid, nombre in list(self._nombres_hilos.items()):
+            eventos.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": nombre}})
+        datos = {"traceEvents": eventos, "displayTimeUnit": "ms"}
+        if ruta_archivo:
+            with open(ruta_archivo, "w", encoding="utf-8") as archivo:
+                json.dump(datos, archivo)
+        return datos
+
+    def exportar_flamegraph(self, ruta_archivo=None, fuente="spans"):
+        """
+        Pilas colapsadas ("a;b;c valor" por línea). fuente="spans" pondera por
+        microsegundos propios de cada span; fuente="muestras" usa el perfilador
+        """
+        with self._lock:
+            pilas = dict(self._pilas_muestras if fuente == "muestras" else self._pilas_spans)
+        texto = "\n".join(f"{pila} {valor}" for pila, valor in sorted(pilas.items()) if valor > 0)
+        if ruta_archivo:
+            with open(ruta_archivo, "w", encoding="utf-8") as archivo:
+                archivo.write(texto + "\n")
+        return texto